@@ -0,0 +1,318 @@
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import tempfile
+import argparse
+import platform
+import subprocess
+
+import yaml
+
+from mdss.config import SiteConfig
+from mdss.site_gen import SiteGenerator
+from mdss.constants import CONTENT_FILES_EXTENSION
+
+
+# theme used for synthetic sites: uses the navigation variables available to
+# templates, as a typical theme would
+BENCHMARK_TEMPLATE = """<html>
+<head><title>{{ title }} - {{ sitename }}</title></head>
+<body>
+<nav>
+{% for b in breadcrumbs %}<a href="{{ b.path }}">{{ b.title }}</a> / {% endfor %}
+</nav>
+<ul>
+{% for s in siblings %}<li><a href="{{ s.path }}">{{ s.title }}</a></li>{% endfor %}
+</ul>
+<h1>{{ title }}</h1>
+{{ content }}
+<ul>
+{% for c in children %}<li><a href="{{ c.path }}">{{ c.title }}</a></li>{% endfor %}
+</ul>
+</body>
+</html>
+"""
+
+BENCHMARK_MACROS = """
+def callout(text, title="Note"):
+    return "<div class='callout'><b>{}</b> {}</div>".format(title, text)
+"""
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+         "eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+
+CODE_BLOCK = """```python
+def function_{n}(x, y={n}):
+    # add some numbers together
+    total = 0
+    for i in range(x):
+        total += i * y
+    return total
+```
+"""
+
+STATIC_EXTENSIONS = ["css", "js", "png"]
+
+
+def generate_body(rng, body_size, code_density, macro_density):
+    """
+    Return markdown content of roughly `body_size` characters. Each paragraph
+    is followed by a code block with probability `code_density` and by a
+    macro invocation with probability `macro_density`
+    """
+    parts = []
+    size = 0
+    while size < body_size:
+        start = len(parts)
+        words = [rng.choice(WORDS) for _ in range(rng.randint(20, 80))]
+        para = " ".join(words).capitalize() + "."
+        if rng.random() < 0.3:
+            para = "## " + " ".join(words[:4]).capitalize() + "\n\n" + para
+        parts.append(para)
+        if rng.random() < code_density:
+            parts.append(CODE_BLOCK.format(n=rng.randint(0, 10)))
+        if rng.random() < macro_density:
+            parts.append("<?callout title='Tip'>Remember to **{}**<?/callout>"
+                         .format(rng.choice(WORDS)))
+        size += sum(len(p) for p in parts[start:])
+    return "\n\n".join(parts) + "\n"
+
+
+def page_location(i, depth, fanout):
+    """
+    Return the directory components for the i-th page. Pages are spread over
+    the leaf directories of a tree of directories `depth` levels deep with
+    `fanout` directories at each level, e.g. with a fan-out of 10 the digits
+    of i % 10 ** depth give the directories from the top level down
+    """
+    leaf = i % fanout ** depth
+    return ["d{}".format((leaf // fanout ** (depth - level - 1)) % fanout)
+            for level in range(depth)]
+
+
+def generate_site(directory, pages=1000, depth=3, fanout=10, body_size=2000,
+                  code_density=0.2, macro_density=0.1, static_files=50,
+                  static_size=10000, seed=0):
+    """
+    Write a synthetic site to `directory`: content files, a theme, static
+    files and a config file. Return the path to the config file
+    """
+    rng = random.Random(seed)
+    content = os.path.join(directory, "content")
+    theme = os.path.join(directory, "theme")
+    os.makedirs(content)
+    os.makedirs(theme)
+
+    with open(os.path.join(theme, "base.html"), "w") as f:
+        f.write(BENCHMARK_TEMPLATE)
+
+    for i in range(pages):
+        location = page_location(i, depth, fanout)
+        page_dir = os.path.join(content, *location)
+        os.makedirs(page_dir, exist_ok=True)
+        filename = "page{}.{}".format(i, CONTENT_FILES_EXTENSION)
+        context = {"title": "Page {}".format(i)}
+        body = generate_body(rng, body_size, code_density, macro_density)
+        with open(os.path.join(page_dir, filename), "w") as f:
+            f.write(yaml.dump(context) + "---\n" + body)
+
+    for i in range(static_files):
+        ext = STATIC_EXTENSIONS[i % len(STATIC_EXTENSIONS)]
+        # put half of the static files in the theme and half in the content
+        base = theme if i % 2 else content
+        static_dir = os.path.join(base, "static",
+                                  *page_location(i, depth - 1, fanout))
+        os.makedirs(static_dir, exist_ok=True)
+        with open(os.path.join(static_dir, "file{}.{}".format(i, ext)),
+                  "wb") as f:
+            f.write(bytes(rng.getrandbits(8) for _ in range(static_size)))
+
+    config_path = os.path.join(directory, SiteConfig.config_filename)
+    with open(config_path, "w") as f:
+        f.write(yaml.dump({
+            "content": content,
+            "theme_dir": theme,
+            "default_context": {"sitename": "Benchmark site"},
+            "macros": BENCHMARK_MACROS,
+            "static_filenames": STATIC_EXTENSIONS,
+        }))
+    return config_path
+
+
+class Timer:
+    """
+    Context manager recording the time taken in a dict under `name`
+    """
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *_):
+        self.timings[self.name] = time.perf_counter() - self.start
+
+
+def time_phases(config_path, export_dir, jobs=None):
+    """
+    Build the site once, timing each phase separately. Return a dict mapping
+    phase name -> time in seconds
+    """
+    config = SiteConfig(config_path)
+    if jobs is not None:
+        config["jobs"] = config.process_jobs(jobs)
+    timings = {}
+
+    with Timer(timings, "walk"):
+        list(SiteGenerator.walk_tree(config.content,
+                                     [CONTENT_FILES_EXTENSION]))
+
+    s_gen = SiteGenerator(config)
+    with Timer(timings, "tree"):
+        s_gen.build_tree()
+        # navigation is computed lazily; count it as part of building the
+        # tree
+        s_gen.tree.navigation
+
+    pages = list(s_gen.tree)
+    with Timer(timings, "render"):
+        rendered = list(s_gen.render_pages(pages))
+
+    with Timer(timings, "write"):
+        for page, (html, _) in zip(pages, rendered):
+            s_gen.write_output(export_dir,
+                               os.path.join(page.dest_path[1:], "index.html"),
+                               html)
+
+    with Timer(timings, "static"):
+        s_gen.export_static(export_dir)
+
+    return timings
+
+
+def time_builds(config_path, export_dir, jobs=None):
+    """
+    Time a full build into an empty export directory followed by a rebuild
+    with nothing changed. Return a dict of timings
+    """
+    timings = {}
+
+    def build():
+        config = SiteConfig(config_path)
+        if jobs is not None:
+            config["jobs"] = config.process_jobs(jobs)
+        SiteGenerator(config).gen_site(export_dir)
+
+    with Timer(timings, "full_build"):
+        build()
+    with Timer(timings, "noop_rebuild"):
+        build()
+    return timings
+
+
+def git_commit():
+    """
+    Return the current commit of the mdss source tree, if available
+    """
+    try:
+        out = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode("ascii").strip()
+
+
+def run_benchmark(directory, repeat=1, jobs=None, **site_params):
+    """
+    Generate a synthetic site in `directory` and time building it `repeat`
+    times. Return the results as a JSON-serialisable dict; the time reported
+    for each phase is the minimum over all repeats
+    """
+    config_path = generate_site(directory, **site_params)
+
+    runs = []
+    for i in range(repeat):
+        run_dir = os.path.join(directory, "output", str(i))
+        timings = time_phases(config_path, os.path.join(run_dir, "phases"),
+                              jobs=jobs)
+        timings.update(time_builds(config_path,
+                                   os.path.join(run_dir, "build"), jobs=jobs))
+        runs.append(timings)
+
+    return {
+        "params": dict(site_params, repeat=repeat, jobs=jobs),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timings": {name: min(run[name] for run in runs) for name in runs[0]},
+        "runs": runs,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m mdss.benchmark",
+        description="Generate a synthetic site and time each build phase"
+    )
+    parser.add_argument("--pages", type=int, default=1000,
+                        help="Number of content pages (default: 1000)")
+    parser.add_argument("--depth", type=int, default=3,
+                        help="Depth of the directory tree (default: 3)")
+    parser.add_argument("--fanout", type=int, default=10,
+                        help="Subdirectories per directory (default: 10)")
+    parser.add_argument("--body-size", type=int, default=2000,
+                        help="Approximate size of each page body in "
+                             "characters (default: 2000)")
+    parser.add_argument("--code-density", type=float, default=0.2,
+                        help="Probability of a code block after each "
+                             "paragraph (default: 0.2)")
+    parser.add_argument("--macro-density", type=float, default=0.1,
+                        help="Probability of a macro invocation after each "
+                             "paragraph (default: 0.1)")
+    parser.add_argument("--static-files", type=int, default=50,
+                        help="Number of static files (default: 50)")
+    parser.add_argument("--static-size", type=int, default=10000,
+                        help="Size of each static file in bytes "
+                             "(default: 10000)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed (default: 0)")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Number of times to build the site (default: 1)")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="Number of processes to render pages with")
+    parser.add_argument("--dir",
+                        help="Directory to generate the site in (default: a "
+                             "temporary directory, removed afterwards)")
+    parser.add_argument("-o", "--output",
+                        help="File to write JSON results to (default: stdout)")
+    args = parser.parse_args()
+
+    directory = args.dir or tempfile.mkdtemp(prefix="mdss-benchmark-")
+    try:
+        results = run_benchmark(
+            directory, repeat=args.repeat, jobs=args.jobs, pages=args.pages,
+            depth=args.depth, fanout=args.fanout, body_size=args.body_size,
+            code_density=args.code_density, macro_density=args.macro_density,
+            static_files=args.static_files, static_size=args.static_size,
+            seed=args.seed
+        )
+    finally:
+        if not args.dir:
+            shutil.rmtree(directory)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import os
+import pickle
+
+
+class FrontMatterCache:
+    """
+    Persistent cache of the parsed context sections of content files, and the
+    position at which each file's content section starts. Entries are keyed
+    on the file's path and are only used while the file's device, inode,
+    modification time and size are unchanged
+    """
+    version = 2
+    filename = "frontmatter.pickle"
+
+    def __init__(self, path=None):
+        """
+        path - location of the cache on disk. If None the cache is only held
+               in memory
+        """
+        self.path = path
+        # map absolute path -> (file identity, context, content offset) from
+        # the last build
+        self.entries = {}
+        # entries looked up or added in this build. Only these are saved, so
+        # that entries for deleted files are dropped
+        self.used = {}
+
+        if self.path:
+            self.load()
+
+    @classmethod
+    def location(cls, cache_dir):
+        return os.path.join(cache_dir, cls.filename)
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                version, entries = pickle.load(f)
+        except (IOError, EOFError, ValueError, TypeError,
+                pickle.UnpicklingError):
+            return
+        if version == self.version:
+            self.entries = entries
+
+    def get(self, src_path, identity):
+        """
+        Return (context, content offset) for a file from the cache, or None
+        if the file is not in the cache or has changed. `identity` should be
+        the result of file_identity(), taken before the file is read
+        """
+        key = os.path.abspath(src_path)
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != identity:
+            return None
+        self.used[key] = entry
+        return entry[1:]
+
+    def set(self, src_path, identity, context, content_offset):
+        self.used[os.path.abspath(src_path)] = (identity, context,
+                                                content_offset)
+
+    def save(self):
+        """
+        Keep the entries used in this build for the next one, and write them
+        to disk if the cache has a path. An in-memory cache can be reused for
+        later builds in the same process
+        """
+        self.entries, self.used = self.used, {}
+        if not self.path:
+            return
+        par_dir = os.path.dirname(self.path)
+        if par_dir and not os.path.isdir(par_dir):
+            os.makedirs(par_dir)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((self.version, self.entries), f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,98 @@
+import os
+import zlib
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - brotli is optional
+    brotli = None
+
+
+# map format -> extension of precompressed files
+PRECOMPRESS_FORMATS = {"gzip": ".gz", "brotli": ".br"}
+
+# extensions of output files worth compressing: text formats, as opposed to
+# images, fonts and archives which are already compressed
+COMPRESSIBLE_EXTENSIONS = ["html", "htm", "css", "js", "mjs", "json", "xml",
+                           "svg", "txt", "csv", "map", "md"]
+
+
+def is_compressible(path):
+    ext = os.path.splitext(path)[1][1:].lower()
+    return ext in COMPRESSIBLE_EXTENSIONS
+
+
+class GzipCompressor:
+    """
+    Streaming gzip compressor. The gzip header does not include a timestamp,
+    so the output only depends on the input
+    """
+    def __init__(self):
+        self.compressor = zlib.compressobj(9, zlib.DEFLATED,
+                                           16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+
+class BrotliCompressor:
+    """
+    Streaming brotli compressor
+    """
+    def __init__(self):
+        self.compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=11)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.finish()
+
+
+COMPRESSORS = {"gzip": GzipCompressor, "brotli": BrotliCompressor}
+
+
+def gzip_chunks(chunks):
+    """
+    Compress an iterable of strings with GzipCompressor, yielding bytes
+    """
+    compressor = GzipCompressor()
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def is_up_to_date(src, dest):
+    """
+    Return True if `dest` was compressed from the current version of `src`.
+    Compressed files are given the modification time of their source, so it
+    is enough to compare modification times
+    """
+    try:
+        return os.stat(dest).st_mtime_ns == os.stat(src).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def compress_file(src, dest, fmt, block_size=1 << 16):
+    """
+    Write a compressed copy of `src` to `dest` in format `fmt`, unless it is
+    already up to date. Return 'added', 'changed' or 'unchanged'
+    """
+    if is_up_to_date(src, dest):
+        return "unchanged"
+    existed = os.path.lexists(dest)
+    compressor = COMPRESSORS[fmt]()
+    tmp_path = dest + ".tmp"
+    with open(src, "rb") as src_f, open(tmp_path, "wb") as dest_f:
+        for block in iter(lambda: src_f.read(block_size), b""):
+            dest_f.write(compressor.compress(block))
+        dest_f.write(compressor.flush())
+        st = os.fstat(src_f.fileno())
+    os.utime(tmp_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.replace(tmp_path, dest)
+    return "changed" if existed else "added"
@@ -1,7 +1,11 @@
 import os.path
 from collections import namedtuple
 
-import yaml
+from mdss.utils import fingerprint, load_yaml
+from mdss.static import COPY_MODES
+from mdss.sitemap import MAX_URLS, SITEMAP_FORMATS
+from mdss.compress import PRECOMPRESS_FORMATS, brotli
+from mdss.search import MAX_PREFIX_LENGTH
 
 
 ConfigOption = namedtuple("ConfigOption", ["name", "default"])
@@ -22,7 +26,7 @@ class BaseConfig(dict):
 
         self.path = path
         with open(self.path) as f:
-            d = yaml.load(f) or {}
+            d = load_yaml(f) or {}
 
         for opt in self.options:
             if opt.name in d:
@@ -66,12 +70,26 @@ class SiteConfig(BaseConfig):
         ConfigOption("default_template", "base.html"),
         ConfigOption("default_context", {}),
         ConfigOption("macros", ""),
+        ConfigOption("pure_macros", []),
         ConfigOption("static_filenames", ["css", "js", "png", "jpg", "gif",
                                           "ico", "wav", "pdf"]),
+        ConfigOption("static_copy_mode", "copy"),
         ConfigOption("sitemap_file", {}),
+        ConfigOption("cache_dir", ""),
+        ConfigOption("compiled_theme", ""),
+        ConfigOption("jobs", 1),
+        ConfigOption("io_threads", 4),
+        ConfigOption("precompress", []),
+        ConfigOption("minify_html", False),
+        ConfigOption("search_index", {}),
     ]
     error_if_extra = True
 
+    # options that do not affect the content of exported files, and so are
+    # left out of the fingerprint used to decide whether to rebuild pages
+    build_only_options = ["cache_dir", "compiled_theme", "jobs",
+                          "io_threads", "precompress", "static_copy_mode"]
+
     # filename to look for when searching for site config
     config_filename = "mdss_config.yml"
 
@@ -90,6 +108,13 @@ class SiteConfig(BaseConfig):
             err_msg = "Cannot find '{}' file".format(cls.config_filename)
             raise ValueError(err_msg)
 
+    def fingerprint(self):
+        """
+        Return a hash of all options that affect rendered output
+        """
+        return fingerprint({k: v for k, v in self.items()
+                            if k not in self.build_only_options})
+
     def process_content(self, content_dir):
         """
         If not given, set content dir to the parent directory of the config
@@ -102,6 +127,59 @@ class SiteConfig(BaseConfig):
     def process_theme_dir(self, t_path):
         return os.path.expanduser(t_path)
 
+    def process_cache_dir(self, c_path):
+        return os.path.expanduser(c_path)
+
+    def process_compiled_theme(self, c_path):
+        return os.path.expanduser(c_path)
+
+    def process_pure_macros(self, names):
+        if (not isinstance(names, list)
+                or not all(isinstance(name, str) for name in names)):
+            raise ValueError("'pure_macros' must be a list of macro names")
+        return names
+
+    def process_jobs(self, jobs):
+        """
+        Validate the number of worker processes to render pages with. 0 means
+        use one process per CPU
+        """
+        if not isinstance(jobs, int) or jobs < 0:
+            raise ValueError("'jobs' must be a non-negative integer")
+        return jobs or os.cpu_count() or 1
+
+    def process_io_threads(self, io_threads):
+        """
+        Validate the number of threads used to write pages when rendering in
+        a single process. 0 disables the read/render/write pipeline
+        """
+        if not isinstance(io_threads, int) or io_threads < 0:
+            raise ValueError("'io_threads' must be a non-negative integer")
+        return io_threads
+
+    def process_precompress(self, formats):
+        if not isinstance(formats, list):
+            raise ValueError("'precompress' must be a list")
+        for fmt in formats:
+            if fmt not in PRECOMPRESS_FORMATS:
+                raise ValueError("'precompress' formats must be from: {}"
+                                 .format(", ".join(PRECOMPRESS_FORMATS)))
+        if "brotli" in formats and brotli is None:
+            raise ValueError("the 'brotli' package must be installed to "
+                             "precompress files with brotli")
+        return formats
+
+    def process_minify_html(self, minify_html):
+        if not isinstance(minify_html, bool):
+            raise ValueError("'minify_html' must be true or false")
+        return minify_html
+
+    def process_static_copy_mode(self, mode):
+        if mode not in COPY_MODES:
+            raise ValueError("'static_copy_mode' must be one of: {}"
+                             .format(", ".join(COPY_MODES)))
+        return mode
+
     def process_sitemap_file(self, listing_settings):
         if not listing_settings:
             return None
@@ -110,4 +188,34 @@ class SiteConfig(BaseConfig):
             raise ValueError(
                 "'base_url' and 'filename' must be given in sitemap_file"
             )
+        fmt = listing_settings.get("format", "text")
+        if fmt not in SITEMAP_FORMATS:
+            raise ValueError("sitemap_file format must be one of: {}"
+                             .format(", ".join(SITEMAP_FORMATS)))
+        max_urls = listing_settings.get("max_urls", MAX_URLS)
+        if (not isinstance(max_urls, int) or isinstance(max_urls, bool)
+                or not 1 <= max_urls <= MAX_URLS):
+            raise ValueError("sitemap_file max_urls must be an integer "
+                             "between 1 and {}".format(MAX_URLS))
+        if not isinstance(listing_settings.get("gzip", False), bool):
+            raise ValueError("sitemap_file gzip must be true or false")
         return listing_settings
+
+    def process_search_index(self, settings):
+        if not settings:
+            return None
+        if settings is True:
+            settings = {}
+        if not isinstance(settings, dict):
+            raise ValueError("'search_index' must be true or a dictionary")
+        directory = settings.get("directory", "search")
+        if (not isinstance(directory, str) or not directory
+                or os.path.isabs(directory)):
+            raise ValueError("search_index directory must be a relative path")
+        prefix_length = settings.get("prefix_length", 2)
+        if (not isinstance(prefix_length, int)
+                or isinstance(prefix_length, bool)
+                or not 1 <= prefix_length <= MAX_PREFIX_LENGTH):
+            raise ValueError("search_index prefix_length must be an integer "
+                             "between 1 and {}".format(MAX_PREFIX_LENGTH))
+        return {"directory": directory, "prefix_length": prefix_length}
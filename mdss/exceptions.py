@@ -4,6 +4,12 @@ class NoContentError(Exception):
     """
 
 
+class MergeError(Exception):
+    """
+    The outputs of a sharded build could not be merged
+    """
+
+
 class InvalidPageError(Exception):
     """
     The page contents were invalid
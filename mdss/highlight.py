@@ -0,0 +1,188 @@
+import os
+import json
+import types
+import hashlib
+import functools
+
+import markdown
+from markdown.extensions import Extension, codehilite, fenced_code
+
+from mdss import stats
+
+try:
+    import pygments
+    from pygments.lexers import get_lexer_by_name
+except ImportError:  # pragma: no cover - codehilite works without pygments
+    pygments = None
+
+
+class HighlightCache:
+    """
+    Content-addressed cache of highlighted code blocks. Entries are keyed on
+    a hash of the code, its language and the highlighter options, and are
+    stored as one file per entry so that the cache can be shared by worker
+    processes and persists between builds
+    """
+    version = 1
+    dirname = "highlight"
+
+    # number of entries to keep in memory
+    memory_size = 4096
+
+    def __init__(self, path=None):
+        """
+        path - directory to store entries in. If None entries are only held
+               in memory
+        """
+        self.path = path
+        self.memory = {}
+
+    @classmethod
+    def location(cls, cache_dir):
+        return os.path.join(cache_dir, cls.dirname)
+
+    def key(self, block, shebang):
+        """
+        Return the cache key for a CodeHilite object. All of its attributes
+        (code, language and options) are included, along with the versions of
+        the libraries that produce the output
+        """
+        parts = [self.version, markdown.__version__,
+                 pygments and pygments.__version__, shebang, vars(block)]
+        s = json.dumps(parts, sort_keys=True, default=repr)
+        return hashlib.sha1(s.encode("utf-8")).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], key[2:] + ".html")
+
+    def get(self, key):
+        """
+        Return the cached HTML for a key, or None if it is not in the cache
+        """
+        html = self.memory.get(key)
+        if html is None and self.path:
+            try:
+                with open(self.entry_path(key), encoding="utf-8") as f:
+                    html = f.read()
+            except IOError:
+                return None
+            self.remember(key, html)
+        return html
+
+    def set(self, key, html):
+        self.remember(key, html)
+        if not self.path:
+            return
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a file unique to this process so that workers highlighting
+        # the same code do not clash
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(html)
+        os.replace(tmp_path, path)
+
+    def remember(self, key, html):
+        if len(self.memory) >= self.memory_size:
+            self.memory.clear()
+        self.memory[key] = html
+
+
+# cache used for all code blocks in this process -- see use_cache_dir()
+cache = HighlightCache()
+
+
+def use_cache_dir(cache_dir):
+    """
+    Store highlighted code blocks under `cache_dir`, or only in memory if
+    `cache_dir` is empty
+    """
+    global cache
+    path = HighlightCache.location(cache_dir) if cache_dir else None
+    if cache.path != path:
+        cache = HighlightCache(path)
+
+
+def _cached_hilite(hilite):
+    @functools.wraps(hilite)
+    def inner(self, *args, **kwargs):
+        shebang = kwargs.get("shebang", args[0] if args else True)
+        key = cache.key(self, shebang)
+        html = cache.get(key)
+        if html is None:
+            stats.incr("highlight_cache_misses")
+            html = hilite(self, *args, **kwargs)
+            cache.set(key, html)
+        else:
+            stats.incr("highlight_cache_hits")
+        return html
+    return inner
+
+
+@functools.lru_cache(maxsize=None)
+def _lexer(name, options):
+    return get_lexer_by_name(name, **dict(options))
+
+
+def _cached_get_lexer_by_name(name, **options):
+    """
+    Memoized version of pygments' get_lexer_by_name(). Lexers do not keep
+    any state between calls to get_tokens(), so instances can be reused
+    """
+    try:
+        return _lexer(name, tuple(sorted(options.items())))
+    except TypeError:
+        # unhashable options
+        return get_lexer_by_name(name, **options)
+
+
+def _rebind(func, **names):
+    """
+    Return a copy of function `func` in which the given global names refer to
+    other objects. The module `func` was defined in is left unchanged
+    """
+    namespace = dict(func.__globals__)
+    namespace.update(names)
+    copy = types.FunctionType(func.__code__, namespace, func.__name__,
+                              func.__defaults__, func.__closure__)
+    copy.__kwdefaults__ = func.__kwdefaults__
+    return functools.update_wrapper(copy, func)
+
+
+class CachedCodeHilite(codehilite.CodeHilite):
+    """
+    CodeHilite that uses the highlight cache and memoized lexer lookups
+    """
+    hilite = _cached_hilite(_rebind(
+        codehilite.CodeHilite.hilite,
+        get_lexer_by_name=_cached_get_lexer_by_name
+    ))
+
+
+class CachedHiliteTreeprocessor(codehilite.HiliteTreeprocessor):
+    run = _rebind(codehilite.HiliteTreeprocessor.run,
+                  CodeHilite=CachedCodeHilite)
+
+
+class CachedFencedBlockPreprocessor(fenced_code.FencedBlockPreprocessor):
+    run = _rebind(fenced_code.FencedBlockPreprocessor.run,
+                  CodeHilite=CachedCodeHilite)
+
+
+class HighlightCacheExtension(Extension):
+    """
+    Markdown extension to make the codehilite and fenced_code extensions of a
+    converter highlight code blocks with CachedCodeHilite. It must be listed
+    after those extensions. Other converters are not affected
+    """
+    processors = [("treeprocessors", "hilite", CachedHiliteTreeprocessor),
+                  ("preprocessors", "fenced_code_block",
+                   CachedFencedBlockPreprocessor)]
+
+    def extendMarkdown(self, md):
+        md.registerExtension(self)
+        for registry, name, cls in self.processors:
+            registry = getattr(md, registry)
+            if name in registry:
+                # keep the configured instance, but use the cached version
+                registry[name].__class__ = cls
@@ -1,6 +1,7 @@
 import re
 from html.parser import HTMLParser
 
+from mdss import stats
 from mdss.page import Page
 
 
@@ -33,13 +34,24 @@ class MacroHandler:
         flags=re.DOTALL
     )
 
-    def __init__(self, code_str, filename):
+    def __init__(self, code_str, filename, pure=()):
         """
-        Parse function definitions from `code_str`
+        Parse function definitions from `code_str`.
+
+        `pure` is a list of names of macros whose output depends only on their
+        arguments; the result of each distinct invocation of these is cached
         """
         self.macros = MacroHandler.parse_string(code_str, filename)
         self.kwargs_parser = HTMLAttributeParser()
 
+        unknown = set(pure) - set(self.macros)
+        if unknown:
+            raise ValueError("Unknown macro(s) listed as pure: {}"
+                             .format(", ".join(sorted(unknown))))
+        self.pure = set(pure)
+        # map (name, kwargs, inner string) -> output for pure macros
+        self.cache = {}
+
     @classmethod
     def parse_string(cls, code_str, filename):
         """
@@ -68,16 +80,33 @@ class MacroHandler:
         A function to be used with re.sub to replace a macro innovation with
         macro output
         """
+        name = match.group("name")
         try:
-            func = self.macros[match.group("name")]
+            func = self.macros[name]
         except KeyError:
-            raise KeyError("Macro '{}' not found".format(match.group("name")))
+            raise KeyError("Macro '{}' not found".format(name))
 
         kwargs = {}
         if match.group("kwargs") is not None:
             kwargs = self.kwargs_parser(match.group("kwargs"))
 
-        content = Page.content_to_html(match.group("string"))
+        stats.incr("macro_expansions")
+        if name in self.pure:
+            key = (name, tuple(sorted(kwargs.items())), match.group("string"))
+            if key in self.cache:
+                stats.incr("macro_cache_hits")
+            else:
+                stats.incr("macro_cache_misses")
+                self.cache[key] = self.call_macro(func, match.group("string"),
+                                                  kwargs)
+            return self.cache[key]
+        return self.call_macro(func, match.group("string"), kwargs)
+
+    def call_macro(self, func, string, kwargs):
+        """
+        Convert the markdown inside a macro invocation and call the macro
+        """
+        content = Page.content_to_html(string)
         # Remove top-level <p> if present
         start_tag = "<p>"
         end_tag = "</p>"
@@ -0,0 +1,131 @@
+import os
+import json
+import hashlib
+
+from mdss.utils import file_signature
+
+
+class BuildManifest:
+    """
+    Record of the inputs used to produce each output file in the previous
+    build, used to skip re-rendering outputs whose inputs have not changed.
+    The paths of all files written to the export directory (including static
+    files) are also kept, so that outputs removed since the previous build
+    can be found
+    """
+    version = 1
+
+    # filename used when the manifest is stored in the export directory
+    filename = ".mdss_manifest.json"
+
+    def __init__(self, path=None):
+        """
+        path - location of the manifest on disk. If None the manifest is only
+               held in memory
+        """
+        self.path = path
+        # records from the previous build and the current one, each mapping
+        # output path (relative to export dir) to a dict of inputs
+        self.previous = {}
+        self.outputs = {}
+        # all output paths from the previous build and the current one
+        self.previous_files = []
+        self.files = []
+        # cache of file signatures so that each dependency is only stat'd
+        # once per build
+        self._signatures = {}
+
+        if self.path:
+            self.load()
+
+    @classmethod
+    def location(cls, export_dir, cache_dir=None):
+        """
+        Return the path at which to store the manifest for an export
+        directory: either inside the export directory itself, or in
+        `cache_dir` if given
+        """
+        if not cache_dir:
+            return os.path.join(export_dir, cls.filename)
+        key = hashlib.sha1(os.path.abspath(export_dir).encode("utf-8"))
+        return os.path.join(cache_dir,
+                            "manifest-{}.json".format(key.hexdigest()[:12]))
+
+    def load(self):
+        """
+        Read records from the previous build. A missing or unreadable manifest
+        is treated as empty, so that everything is rebuilt
+        """
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return
+        if isinstance(data, dict) and data.get("version") == self.version:
+            self.previous = data.get("outputs", {})
+            self.previous_files = data.get("files", [])
+
+    def signature(self, path):
+        if path not in self._signatures:
+            self._signatures[path] = file_signature(path)
+        return self._signatures[path]
+
+    def is_current(self, output, **inputs):
+        """
+        Return True if `output` was produced in the previous build from the
+        given inputs, and none of the templates it used have changed since
+        """
+        record = self.previous.get(output)
+        if record is None:
+            return False
+        for key, value in inputs.items():
+            if record.get(key) != value:
+                return False
+        for path, sig in record.get("templates", {}).items():
+            if self.signature(path) != sig:
+                return False
+        return True
+
+    def keep(self, output):
+        """
+        Carry the record for an up to date output over from the previous build
+        """
+        self.outputs[output] = self.previous[output]
+
+    def add(self, output, templates=(), data=None, **inputs):
+        """
+        Record the inputs used to produce `output` in this build. `templates`
+        is a list of paths to the template files used. `data` is an optional
+        dict of values derived while rendering the output (e.g. its search
+        index terms), which are kept so that they are still available in
+        later builds that skip the output
+        """
+        record = dict(inputs)
+        record["templates"] = {path: self.signature(path) for path in templates}
+        if data:
+            record["data"] = data
+        self.outputs[output] = record
+
+    def get_data(self, output):
+        """
+        Return the data recorded for `output` in this build, or in the
+        previous build if it has not been recorded yet
+        """
+        record = self.outputs.get(output, self.previous.get(output, {}))
+        return record.get("data", {})
+
+    def save(self):
+        """
+        Write the records for this build to disk, replacing the previous
+        manifest atomically
+        """
+        if not self.path:
+            return
+        par_dir = os.path.dirname(self.path)
+        if par_dir and not os.path.isdir(par_dir):
+            os.makedirs(par_dir)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": self.version, "outputs": self.outputs,
+                       "files": sorted(self.files)}, f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,133 @@
+import re
+
+from mdss import stats
+
+
+# elements whose contents are left untouched, and comments (which are
+# removed, apart from conditional comments)
+RAW_BLOCK = re.compile(
+    r"<(pre|textarea|script|style|code)(?=[\s>/]).*?</\1\s*>|<!--.*?-->",
+    flags=re.IGNORECASE | re.DOTALL
+)
+# start of a raw block or comment, which may not be complete
+RAW_START = re.compile(r"<(?:pre|textarea|script|style|code)(?=[\s>/])|<!--",
+                       flags=re.IGNORECASE)
+
+# a complete tag, whose quoted attribute values may contain '>'. Whitespace
+# inside tags is left alone, so attribute values are not changed
+TAG = re.compile(r"""<[A-Za-z/!?][^>"']*(?:(?:"[^"]*"|'[^']*')[^>"']*)*>""")
+# a complete tag, or the start of one that is not complete
+TAG_OR_START = re.compile(r"(?P<tag>{})|<[A-Za-z/!?]".format(TAG.pattern))
+
+# whitespace containing a line break, and runs of other whitespace. Only
+# ASCII whitespace is collapsed: other characters such as non-breaking spaces
+# affect how the page is displayed
+LINE_BREAKS = re.compile(r"[ \t\r\f]*\n[ \t\r\n\f]*")
+SPACES = re.compile(r"[ \t\r\f]{2,}")
+
+
+def collapse_whitespace(text):
+    """
+    Collapse runs of whitespace in the text outside tags in `text`
+    """
+    out = []
+    pos = 0
+    for match in TAG.finditer(text):
+        out.append(SPACES.sub(" ", LINE_BREAKS.sub("\n",
+                                                    text[pos:match.start()])))
+        out.append(match.group())
+        pos = match.end()
+    out.append(SPACES.sub(" ", LINE_BREAKS.sub("\n", text[pos:])))
+    return "".join(out)
+
+
+def _append_collapsed(out, text):
+    """
+    Append `text` to `out` with whitespace collapsed, and return the number
+    of bytes removed
+    """
+    collapsed = collapse_whitespace(text)
+    out.append(collapsed)
+    return len(text.encode("utf-8")) - len(collapsed.encode("utf-8"))
+
+
+def minify(html):
+    """
+    Return minified HTML: comments are removed and runs of whitespace are
+    collapsed to a single character, which does not change how the page is
+    displayed. <pre>, <code>, <textarea>, <script> and <style> elements
+    (including code blocks highlighted by codehilite) are left as they are.
+
+    The number of bytes saved is added to the 'minify_bytes_saved' counter
+    """
+    out = []
+    saved = 0
+    # text between kept blocks; removed comments are skipped, so that
+    # whitespace either side of them is collapsed together
+    text = []
+    pos = 0
+    for match in RAW_BLOCK.finditer(html):
+        text.append(html[pos:match.start()])
+        pos = match.end()
+        block = match.group()
+        if block.startswith("<!--") and not block.startswith("<!--[if"):
+            saved += len(block.encode("utf-8"))
+            continue
+        saved += _append_collapsed(out, "".join(text))
+        text = []
+        out.append(block)
+
+    text.append(html[pos:])
+    saved += _append_collapsed(out, "".join(text))
+    stats.incr("minify_bytes_saved", saved)
+    return "".join(out)
+
+
+def safe_cut(html):
+    """
+    Return a position at which `html` can be split so that both parts can be
+    minified separately with the same result, or 0 if there is none. The cut
+    is just after a complete tag, so it is never inside a raw block, comment,
+    tag or run of whitespace
+    """
+    complete = 0
+    for match in RAW_BLOCK.finditer(html):
+        complete = match.end()
+    start = RAW_START.search(html, complete)
+    limit = start.start() if start else len(html)
+    cut = 0
+    for match in TAG_OR_START.finditer(html, complete, limit):
+        if match.group("tag") is None:
+            # the rest of this tag has not been seen yet
+            break
+        cut = match.end()
+    return cut
+
+
+def minify_chunks(chunks, buffer_size=1 << 16):
+    """
+    Minify HTML given as an iterable of strings (e.g. from
+    template.generate()), yielding minified chunks. Input is buffered until
+    at least `buffer_size` characters are available, so memory use stays
+    bounded for large pages
+    """
+    pending = []
+    size = 0
+    threshold = buffer_size
+    for chunk in chunks:
+        pending.append(chunk)
+        size += len(chunk)
+        if size < threshold:
+            continue
+        buf = "".join(pending)
+        cut = safe_cut(buf)
+        if cut:
+            yield minify(buf[:cut])
+            buf = buf[cut:]
+        pending = [buf]
+        size = len(buf)
+        # if a large raw block could not be cut, wait for more input before
+        # trying again
+        threshold = max(buffer_size, 2 * size)
+    if pending:
+        yield minify("".join(pending))
@@ -1,12 +1,14 @@
+import os
+import threading
 from operator import attrgetter
 
-import yaml
-from yaml.parser import ParserError
-from yaml.scanner import ScannerError
+from yaml import YAMLError
 import markdown
 
+from mdss import stats
 from mdss.exceptions import InvalidPageError
-from mdss.utils import remove_extension, transfer_pages
+from mdss.utils import (remove_extension, transfer_pages, load_yaml,
+                        stat_identity)
 from mdss.constants import CONTENT_FILES_EXTENSION
 
 
@@ -30,7 +32,7 @@ class PageInfo:
     def __init__(self, path, title, children=None):
         self.path = path
         self.title = title
-        self.children = children or []
+        self.children = children or ()
 
 
 class Page:
@@ -46,12 +48,31 @@ class Page:
     markdown_extensions = ["markdown.extensions.tables",
                            "markdown.extensions.fenced_code",
                            "markdown.extensions.toc",
-                           "markdown.extensions.codehilite"]
+                           "markdown.extensions.codehilite",
+                           # must come after codehilite and fenced_code
+                           "mdss.highlight:HighlightCacheExtension"]
 
-    def __init__(self, p_id, src_path=None):
+    # extension added when the search index is enabled, to keep the text of
+    # each page
+    search_extension = "mdss.search:SearchTextExtension"
+
+    # Markdown converters are expensive to create, so one is kept per thread
+    # (and so per worker process) and reset between documents
+    _converters = threading.local()
+
+    def __init__(self, p_id, src_path=None, context=None,
+                 content_offset=None, identity=None):
         """
-        p_id        - page ID
-        src_path    - path on disk to content file (optional)
+        p_id           - page ID
+        src_path       - path on disk to content file (optional)
+        context        - parsed context section of the content file, if
+                         already known (optional). If given the file is not
+                         read until the content is needed
+        content_offset - position of the content section in the file, if
+                         `context` is given
+        identity       - file_identity() of the file that `context` and
+                         `content_offset` are from. If the file has changed
+                         when the content is read, the context is read again
         """
         self.id = p_id
         self.src_path = src_path
@@ -64,20 +85,89 @@ class Page:
         # list of child page IDs in order that they should appear. Use default
         # ordering if None
         self.child_ordering = None
+        # map child page ID -> position in child_ordering
+        self.child_positions = {}
+        # children in sorted order, cached until a child is added
+        self._sorted_children = None
+
+        # parsed context section and raw markdown content from the source
+        # file. Only the context is read up front, along with the position of
+        # the content in the file and the identity of the file; the content
+        # is read when the page is rendered and released afterwards (see
+        # get_source() and release_content())
+        self.context = {}
+        self.content = ""
+        self.content_offset = None
+        self.source_identity = None
 
         self.title = self.get_default_title(self.id)
         if self.src_path:
-            context, _ = self.read_page_source(context_only=True)
-
-            if "title" in context:
-                self.title = context["title"]
-
-            if "page_ordering" in context:
+            if context is None:
+                self.context, _ = self.read_page_source(context_only=True)
+            else:
+                self.context = context
+                self.content_offset = content_offset
+                self.source_identity = identity
+            self.content = None
+
+            if "title" in self.context:
+                self.title = self.context["title"]
+
+            if "page_ordering" in self.context:
                 self.child_ordering = [
                     # Remove file extensions if present
                     remove_extension(p, CONTENT_FILES_EXTENSION)
-                    for p in context["page_ordering"]
+                    for p in self.context["page_ordering"]
                 ]
+                for idx, p_id in enumerate(self.child_ordering):
+                    self.child_positions.setdefault(p_id, idx)
+
+    def __getstate__(self):
+        # content is not included when pages are pickled: worker processes
+        # are sent the content only for the pages they render
+        state = self.__dict__.copy()
+        state["content"] = None
+        return state
+
+    def get_source(self):
+        """
+        Return (context, content) for this page, reading the content from the
+        source file if it has not been read yet or has been released
+        """
+        if self.content is None:
+            self.content = self.read_content()
+        return self.context, self.content
+
+    def read_content(self):
+        """
+        Read and return the content section of the source file, starting from
+        where the context section read earlier ended. If the file has changed
+        since then, it is read again from the start and the context is parsed
+        again, so that the context and content always come from the same
+        version of the file
+        """
+        if not self.src_path:
+            return ""
+        with open(self.src_path) as f:
+            st = os.fstat(f.fileno())
+            stats.incr("files_read")
+            if (self.content_offset is not None
+                    and stat_identity(st) == self.source_identity):
+                f.seek(self.content_offset)
+                stats.incr("bytes_read", st.st_size - self.content_offset)
+                return self.read_content_section(f)
+
+            stats.incr("bytes_read", st.st_size)
+            self.context = self.parse_context(self.read_context_section(f))
+            self.content_offset = f.tell()
+            self.source_identity = stat_identity(st)
+            return self.read_content_section(f)
+
+    def release_content(self):
+        """
+        Drop the page's content once it is no longer needed
+        """
+        self.content = None
 
     @cachedproperty
     def breadcrumbs(self):
@@ -113,6 +203,7 @@ class Page:
             transfer_pages(self.children[new_page.id], new_page)
 
         self.children[new_page.id] = new_page
+        self._sorted_children = None
 
     @cachedproperty
     def sort_key(self):
@@ -122,22 +213,28 @@ class Page:
         """
         if not self.child_ordering:
             return attrgetter("title")
+        # use a bound method rather than a closure so that pages can be
+        # pickled and sent to worker processes
+        return self.ordering_key
 
-        def key(page):
-            # Sort by position in child_ordering first, and by title
-            # second
-            try:
-                idx = self.child_ordering.index(page.id)
-            except ValueError:
-                idx = len(self.child_ordering)
-            return (idx, page.title)
-        return key
+    def ordering_key(self, page):
+        """
+        Sort key for child pages when a custom ordering is given: sort by
+        position in child_ordering first, and by title second
+        """
+        idx = self.child_positions.get(page.id, len(self.child_ordering))
+        return (idx, page.title)
 
     def iterchildren(self):
         """
-        Return an iterator over this page's children
+        Return this page's children in sorted order. The order is cached until
+        another child is added
         """
-        return sorted(self.children.values(), key=self.sort_key)
+        if self._sorted_children is None:
+            self._sorted_children = tuple(
+                sorted(self.children.values(), key=self.sort_key)
+            )
+        return self._sorted_children
 
     def child_listing(self):
         """
@@ -151,19 +248,39 @@ class Page:
         return listing
 
     @classmethod
-    def content_to_html(cls, md_str):
+    def get_markdown(cls, search=False):
+        """
+        Return a Markdown converter for the current thread. If `search` is
+        True the converter keeps the text of documents for the search index
+        """
+        if not hasattr(cls._converters, "instances"):
+            cls._converters.instances = {}
+        extensions = list(cls.markdown_extensions)
+        if search:
+            extensions.append(cls.search_extension)
+        key = tuple(extensions)
+        if key not in cls._converters.instances:
+            cls._converters.instances[key] = markdown.Markdown(
+                extensions=extensions
+            )
+        return cls._converters.instances[key]
+
+    @classmethod
+    def content_to_html(cls, md_str, search=False):
         """
         Convert page content and return HTML as a string
         """
-        return markdown.markdown(md_str, extensions=cls.markdown_extensions)
+        stats.incr("markdown_conversions")
+        return cls.get_markdown(search).reset().convert(md_str)
 
     def parse_context(self, context_str):
         """
         Parse the context section and return a dict
         """
+        stats.incr("yaml_parses")
         try:
-            context = yaml.load(context_str) or {}
-        except (ParserError, ScannerError):
+            context = load_yaml(context_str) or {}
+        except YAMLError:
             raise InvalidPageError("Context was not valid YAML in file '{}'"
                                    .format(self.src_path))
 
@@ -180,24 +297,51 @@ class Page:
         """
         if not self.src_path:
             return {}, ""
+        context_str, content = self.split_page_source(context_only)
+        return self.parse_context(context_str), content
 
-        context_str = ""
-        content = ""
-        context_section = True
+    def split_page_source(self, context_only=False):
+        """
+        Read the file and return (context string, content) without parsing
+        the context. The position at which the content starts and the
+        identity of the file are recorded for read_content()
+        """
+        if not self.src_path:
+            return "", ""
 
         with open(self.src_path) as f:
-            for line in f.readlines():
-                if line.strip() == self.section_separator:
-                    if context_only:
-                        break
-                    context_section = False
-                    continue
-                if context_section:
-                    context_str += line
-                else:
-                    content += line
-        context = self.parse_context(context_str)
-        return context, content
+            st = os.fstat(f.fileno())
+            stats.incr("files_read")
+            context_str = self.read_context_section(f)
+            # for the encodings used in practice this is the position in
+            # bytes
+            self.content_offset = f.tell()
+            self.source_identity = stat_identity(st)
+            if context_only:
+                stats.incr("bytes_read", self.content_offset)
+                return context_str, ""
+            stats.incr("bytes_read", st.st_size)
+            return context_str, self.read_content_section(f)
+
+    def read_context_section(self, f):
+        """
+        Read lines from file object `f` up to and including the separator,
+        and return the context section
+        """
+        lines = []
+        # readline() rather than iteration, so that f.tell() can be used
+        for line in iter(f.readline, ""):
+            if line.strip() == self.section_separator:
+                break
+            lines.append(line)
+        return "".join(lines)
+
+    def read_content_section(self, f):
+        """
+        Read the rest of file object `f` and return it as the content section
+        """
+        return "".join(line for line in f
+                       if line.strip() != self.section_separator)
 
 
 class HomePage(Page):
@@ -206,6 +350,8 @@ class HomePage(Page):
     """
     title = "Home"
 
-    def __init__(self, src_path=None):
-        super().__init__(HomePage.title, src_path=src_path)
+    def __init__(self, src_path=None, context=None, content_offset=None,
+                 identity=None):
+        super().__init__(HomePage.title, src_path=src_path, context=context,
+                         content_offset=content_offset, identity=identity)
         self.dest_path = "/"
@@ -0,0 +1,92 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+
+class NullTrace:
+    """
+    Trace that records nothing, used when profiling is not enabled
+    """
+    enabled = False
+    _null_span = nullcontext()
+
+    def span(self, name, cat="phase", **args):
+        return self._null_span
+
+    def pop_events(self):
+        return []
+
+    def add_events(self, events):
+        pass
+
+
+class BuildTrace(NullTrace):
+    """
+    Records timing spans for build phases and pages, which can be written out
+    in Chrome trace event format (viewable in chrome://tracing or Perfetto)
+    """
+    enabled = True
+
+    def __init__(self, origin=None):
+        """
+        origin - time.perf_counter() value that timestamps are relative to.
+                 Worker processes are given the origin of the main process so
+                 that their spans line up
+        """
+        self.origin = time.perf_counter() if origin is None else origin
+        self.events = []
+
+    @contextmanager
+    def span(self, name, cat="phase", **args):
+        """
+        Context manager recording the time spent inside it
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.events.append({
+                "name": name,
+                "cat": cat,
+                "ph": "X",
+                "ts": (start - self.origin) * 1e6,
+                "dur": (time.perf_counter() - start) * 1e6,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": args,
+            })
+
+    def pop_events(self):
+        """
+        Return the events recorded so far and forget them
+        """
+        events, self.events = self.events, []
+        return events
+
+    def add_events(self, events):
+        """
+        Add events recorded by another trace, e.g. in a worker process
+        """
+        self.events.extend(events)
+
+    def slowest_pages(self, n=10):
+        """
+        Return a list of (page path, duration in seconds) for the `n` pages
+        that took longest to render. A page may have several spans, e.g. when
+        it is converted in the main thread and its template rendered in a
+        writer thread, so the durations of all spans for a page are added up
+        """
+        durations = {}
+        for e in self.events:
+            if e["cat"] == "page":
+                durations[e["name"]] = durations.get(e["name"], 0) + e["dur"]
+        pages = sorted(durations.items(), key=lambda item: item[1],
+                       reverse=True)
+        return [(name, dur / 1e6) for name, dur in pages[:n]]
+
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": self.events,
+                       "displayTimeUnit": "ms"}, f)
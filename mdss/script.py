@@ -1,15 +1,110 @@
 import sys
+import json
+import cProfile
 import argparse
 
 from mdss.config import SiteConfig
 from mdss.site_gen import SiteGenerator
+from mdss.serve import DevServer
+from mdss.templates import compile_theme
+from mdss.profiling import BuildTrace
+from mdss.exceptions import MergeError
+from mdss import stats
 
 
-def main():
-    parser = argparse.ArgumentParser()
+def add_common_arguments(parser):
+    parser.add_argument(
+        "-f", "--config-file",
+        dest="config_file",
+        help="Path to site-wide config file"
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        help="Number of processes to render pages with (0 for one per CPU). "
+             "Overrides the 'jobs' config option"
+    )
+
+
+def shard_arg(value):
+    """
+    Parse a shard given as 'i/N' on the command line, where 1 <= i <= N
+    """
+    try:
+        number, count = (int(x) for x in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "shard must be given as i/N, e.g. 1/4"
+        )
+    if not 1 <= number <= count:
+        raise argparse.ArgumentTypeError(
+            "shard number must be between 1 and {}".format(count)
+        )
+    return number, count
+
+
+def serve(argv):
+    parser = argparse.ArgumentParser(
+        prog="mdss serve",
+        description="Build the site in memory and serve it over HTTP, "
+                    "rebuilding and reloading pages when files change"
+    )
+    add_common_arguments(parser)
+    parser.add_argument(
+        "--host",
+        default="localhost",
+        help="Address to listen on (default: localhost)"
+    )
+    parser.add_argument(
+        "-p", "--port",
+        type=int,
+        default=8000,
+        help="Port to listen on (default: 8000)"
+    )
+
+    args = parser.parse_args(argv)
+    config_path = args.config_file or SiteConfig.find_site_config()
+    DevServer(config_path, host=args.host, port=args.port,
+              jobs=args.jobs).serve_forever()
+
+
+def compile_theme_command(argv):
+    parser = argparse.ArgumentParser(
+        prog="mdss compile-theme",
+        description="Precompile the templates in the theme directory, for use "
+                    "with the 'compiled_theme' config option"
+    )
+    parser.add_argument(
+        "target",
+        help="The directory to write compiled templates to"
+    )
+    parser.add_argument(
+        "-f", "--config-file",
+        dest="config_file",
+        help="Path to site-wide config file"
+    )
+
+    args = parser.parse_args(argv)
+    config_path = args.config_file or SiteConfig.find_site_config()
+    for name in compile_theme(SiteConfig(config_path), args.target):
+        print("Compiled {}".format(name))
+
+
+def merge_command(argv):
+    parser = argparse.ArgumentParser(
+        prog="mdss merge",
+        description="Combine the export directories of a build sharded with "
+                    "--shard and write the sitemap file"
+    )
     parser.add_argument(
         "export_dir",
-        help="The directory to export HTML files to"
+        help="The directory to write the combined site to"
+    )
+    parser.add_argument(
+        "shard_dirs",
+        nargs="+",
+        metavar="shard_dir",
+        help="Export directories of the shards"
     )
     parser.add_argument(
         "-f", "--config-file",
@@ -17,11 +112,114 @@ def main():
         help="Path to site-wide config file"
     )
 
+    args = parser.parse_args(argv)
+    config_path = args.config_file or SiteConfig.find_site_config()
+    s_gen = SiteGenerator(SiteConfig(config_path))
+    try:
+        s_gen.merge_shards(args.export_dir, args.shard_dirs)
+    except MergeError as ex:
+        parser.exit(1, "mdss merge: {}\n".format(ex))
+
+
+def main():
+    if sys.argv[1:2] == ["serve"]:
+        serve(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ["compile-theme"]:
+        compile_theme_command(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ["merge"]:
+        merge_command(sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(
+        epilog="Use 'mdss serve' to run a development server, "
+               "'mdss compile-theme' to precompile the theme's templates, or "
+               "'mdss merge' to combine the outputs of a sharded build"
+    )
+    parser.add_argument(
+        "export_dir",
+        help="The directory to export HTML files to"
+    )
+    add_common_arguments(parser)
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Re-render all pages, even if their inputs have not changed "
+             "since the last build"
+    )
+    parser.add_argument(
+        "--shard",
+        metavar="i/N",
+        type=shard_arg,
+        help="Only export the i-th of N shards of the site's pages and static "
+             "files. Combine the shards with 'mdss merge'"
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="TRACE_FILE",
+        help="Record timings for each build phase and page, and write them to "
+             "TRACE_FILE in Chrome trace format (viewable in Perfetto)"
+    )
+    parser.add_argument(
+        "--profile-top",
+        metavar="N",
+        type=int,
+        default=10,
+        help="Number of slowest pages to report with --profile (default: 10)"
+    )
+    parser.add_argument(
+        "--cprofile",
+        metavar="STATS_FILE",
+        help="Run the render loop under cProfile and write the stats to "
+             "STATS_FILE. Pages are rendered one at a time in the main "
+             "thread while profiling; pages rendered in worker processes "
+             "(--jobs) are not profiled"
+    )
+    parser.add_argument(
+        "--changes",
+        metavar="CHANGES_FILE",
+        dest="changes_file",
+        help="Write the lists of output files added, changed and removed by "
+             "this build to CHANGES_FILE as JSON"
+    )
+    parser.add_argument(
+        "--stats",
+        metavar="STATS_FILE",
+        dest="stats_file",
+        help="Write build statistics (files read and written, cache hits, "
+             "peak memory usage etc.) to STATS_FILE as JSON"
+    )
+
     args = parser.parse_args(sys.argv[1:])
 
     config_path = args.config_file or SiteConfig.find_site_config()
     config = SiteConfig(config_path)
-    SiteGenerator(config).gen_site(args.export_dir)
+    if args.jobs is not None:
+        config["jobs"] = config.process_jobs(args.jobs)
+
+    s_gen = SiteGenerator(config)
+    s_gen.shard = args.shard
+    if args.profile:
+        s_gen.trace = BuildTrace()
+    if args.cprofile:
+        s_gen.profiler = cProfile.Profile()
+
+    s_gen.gen_site(args.export_dir, force=args.force)
+
+    if args.profile:
+        s_gen.trace.write(args.profile)
+        print("Slowest pages:", file=sys.stderr)
+        for path, duration in s_gen.trace.slowest_pages(args.profile_top):
+            print("{:10.1f} ms  {}".format(duration * 1000, path),
+                  file=sys.stderr)
+    if args.cprofile:
+        s_gen.profiler.dump_stats(args.cprofile)
+    if args.changes_file:
+        with open(args.changes_file, "w", encoding="utf-8") as f:
+            json.dump(s_gen.output_changes(), f, indent=2)
+    if args.stats_file:
+        stats.write_report(args.stats_file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,132 @@
+import re
+import html
+from collections import Counter
+
+from markdown.extensions import Extension
+from markdown.treeprocessors import Treeprocessor
+from markdown.util import HTML_PLACEHOLDER_RE
+
+
+# version of the search index format, included in the index file
+INDEX_VERSION = 1
+
+# filename of the search index file in the search index directory. Terms are
+# written to separate shard files, one per term prefix
+INDEX_FILENAME = "index.json"
+
+# file in the export directory of a shard of a sharded build holding the
+# search documents for the pages in the shard, for use when the shards are
+# merged. This is not copied to the merged export directory
+DOCUMENTS_FILENAME = ".mdss_search_documents.json"
+
+# maximum number of characters of a term used to choose its shard
+MAX_PREFIX_LENGTH = 4
+
+# weight of each occurrence of a term in each part of a page
+FIELD_WEIGHTS = {"title": 10, "headings": 5, "path": 3, "body": 1}
+
+# shorter terms are not indexed
+MIN_TOKEN_LENGTH = 2
+
+TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """
+    Return a list of the lowercased terms in a string
+    """
+    return [t for t in TOKEN.findall(text.lower())
+            if len(t) >= MIN_TOKEN_LENGTH]
+
+
+class TextCollector(Treeprocessor):
+    """
+    Keep a reference to the element tree of the last converted document, so
+    that its text can be indexed without parsing the HTML again
+    """
+    def run(self, root):
+        self.md.search_tree = root
+
+
+class SearchTextExtension(Extension):
+    """
+    Markdown extension to make the text of converted documents available to
+    page_text()
+    """
+    def extendMarkdown(self, md):
+        md.registerExtension(self)
+        self.md = md
+        md.search_tree = None
+        # run after all other tree processors
+        md.treeprocessors.register(TextCollector(md), "mdss_search_text", -10)
+
+    def reset(self):
+        self.md.search_tree = None
+
+
+def flatten_toc(tokens):
+    for token in tokens:
+        yield token
+        yield from flatten_toc(token["children"])
+
+
+def page_text(md):
+    """
+    Return (list of headings, body text) for the document last converted by
+    Markdown converter `md`. Code blocks, which are stored as raw HTML, are
+    not included in the body text
+    """
+    headings = [html.unescape(token["name"])
+                for token in flatten_toc(getattr(md, "toc_tokens", []))]
+    text = ""
+    if md.search_tree is not None:
+        text = " ".join(md.search_tree.itertext())
+        text = HTML_PLACEHOLDER_RE.sub(" ", text)
+    return headings, text
+
+
+def page_document(path, title, headings, text):
+    """
+    Return the search document for a page: a dict with its path, title and
+    a map of term -> score, where the score is the weighted number of times
+    the term occurs in each part of the page
+    """
+    terms = Counter()
+    fields = {"title": title, "path": path, "headings": " ".join(headings),
+              "body": text}
+    for field, value in fields.items():
+        for term in tokenize(value):
+            terms[term] += FIELD_WEIGHTS[field]
+    return {"path": path, "title": title, "terms": dict(terms)}
+
+
+def shard_filename(prefix):
+    """
+    Return the filename of the shard holding terms starting with `prefix`.
+    Prefixes with non-ASCII characters are hex-encoded so that filenames are
+    safe to use in URLs
+    """
+    if not prefix.isascii():
+        prefix = "x" + prefix.encode("utf-8").hex()
+    return "terms-{}.json".format(prefix)
+
+
+def build_index(documents, prefix_length):
+    """
+    Build an inverted index of a list of search documents. Return a dict
+    mapping term prefix -> {term: postings}, where the postings for a term
+    are a flat list [document number, score, document number, score, ...]
+    ordered by descending score
+    """
+    index = {}
+    for number, document in enumerate(documents):
+        for term, score in document["terms"].items():
+            shard = index.setdefault(term[:prefix_length], {})
+            shard.setdefault(term, []).append((score, number))
+
+    for shard in index.values():
+        for term, postings in shard.items():
+            postings.sort(key=lambda posting: (-posting[0], posting[1]))
+            shard[term] = [value for score, number in postings
+                           for value in (number, score)]
+    return index
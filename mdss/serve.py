@@ -0,0 +1,385 @@
+import os
+import sys
+import time
+import threading
+import traceback
+import mimetypes
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from mdss import stats
+from mdss.config import SiteConfig
+from mdss.exceptions import InvalidPageError
+from mdss.manifest import BuildManifest
+from mdss.cache import FrontMatterCache
+from mdss.site_gen import SiteGenerator
+
+
+class MemorySiteGenerator(SiteGenerator):
+    """
+    Site generator that keeps rendered output in memory instead of writing it
+    to an export directory. Static files are not copied; they are served
+    directly from the theme and content directories
+    """
+    # output is kept in this process, so pages rendered in worker processes
+    # must be sent back
+    write_in_workers = False
+
+    def __init__(self, config):
+        super().__init__(config)
+        # map output path -> file contents as bytes
+        self.files = {}
+        self.manifest = BuildManifest()
+        # parsed context sections are kept between rebuilds, so that only
+        # changed content files are parsed again
+        self.frontmatter_cache = FrontMatterCache()
+
+    def gen_site(self, export_dir="", force=False):
+        super().gen_site(export_dir, force=force)
+        # forget outputs that were not produced by this build, e.g. for pages
+        # that no longer exist
+        self.files = {k: v for k, v in self.files.items()
+                      if k in self.output_status}
+
+    def export_static(self, export_dir):
+        pass
+
+    def precompress(self, export_dir):
+        pass
+
+    def open_manifest(self, export_dir):
+        # the manifest is only kept in memory, with the records from the
+        # previous build carried over
+        manifest = BuildManifest()
+        manifest.previous = self.manifest.outputs
+        manifest.previous_files = self.manifest.files
+        self.manifest = manifest
+        return manifest
+
+    def open_frontmatter_cache(self):
+        return self.frontmatter_cache
+
+    def update_pages(self, paths):
+        """
+        Re-render only the pages whose content files are at `paths`, if that
+        is enough to bring the site up to date: each path must be the source
+        of a page in the tree, and its context must be unchanged so that the
+        tree and navigation are unaffected. Return False without rendering
+        anything if a full build is needed
+        """
+        pages = {page.src_path: page for page in self.tree if page.src_path}
+        to_render = []
+        for path in paths:
+            page = pages.get(path)
+            if page is None:
+                return False
+            try:
+                context, _ = page.read_page_source(context_only=True)
+            except (OSError, InvalidPageError):
+                return False
+            if context != page.context:
+                return False
+            to_render.append(page)
+
+        stats.reset()
+        for page in to_render:
+            page.release_content()
+        outputs = [os.path.join(page.dest_path[1:], "index.html")
+                   for page in to_render]
+        list(self.render_pages(to_render, "", outputs))
+        # the sitemap includes modification times, and the search index the
+        # text of each page
+        self.write_sitemap("")
+        self.write_search_index("")
+        return True
+
+    def output_exists(self, export_dir, output):
+        return output in self.files
+
+    def write_output(self, export_dir, output, text):
+        if isinstance(text, (str, bytes)):
+            text = (text,)
+        data = b"".join(chunk if isinstance(chunk, bytes)
+                        else chunk.encode("utf-8") for chunk in text)
+        previous = self.files.get(output)
+        if previous is None:
+            self.output_status[output] = "added"
+        elif previous == data:
+            self.output_status[output] = "unchanged"
+        else:
+            self.output_status[output] = "changed"
+        self.files[output] = data
+
+    def find_static_file(self, path):
+        """
+        Return the path on disk of the static file at `path` (relative to the
+        site root), or None if there is no such file. As when exporting, files
+        in the content directory take precedence over those in the theme
+        """
+        ext = os.path.splitext(path)[1][1:]
+        if ext not in self.config.static_filenames:
+            return None
+        for d in (self.config.content, self.config.theme_dir):
+            full_path = os.path.normpath(os.path.join(d, path))
+            # do not allow paths to escape the directory
+            if not full_path.startswith(os.path.normpath(d) + os.path.sep):
+                continue
+            if os.path.isfile(full_path):
+                return full_path
+        return None
+
+
+class DevServer:
+    """
+    Development server that builds the site into memory, rebuilds it when
+    source files change and serves it over HTTP. Pages served include a
+    script that reloads the page in the browser after each rebuild
+    """
+
+    # URL polled by the reload script
+    reload_path = "/__mdss_reload__"
+
+    reload_script = (
+        "<script>(function() {{"
+        "var v = {version};"
+        "function poll() {{"
+        "fetch('" + reload_path + "?version=' + v)"
+        ".then(function(r) {{ return r.text(); }})"
+        ".then(function(t) {{ if (t !== String(v)) {{ location.reload(); }}"
+        " else {{ poll(); }} }})"
+        ".catch(function() {{ setTimeout(poll, 1000); }});"
+        "}}"
+        "poll();"
+        "}})();</script>"
+    )
+
+    def __init__(self, config_path, host="localhost", port=8000,
+                 interval=0.1, jobs=None):
+        """
+        config_path - path to the site config file
+        interval    - time in seconds between checks for changed files
+        jobs        - override for the 'jobs' config option
+        """
+        self.config_path = config_path
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.jobs = jobs
+
+        self.generator = None
+        self.snapshot = {}
+        # whether the last full build succeeded. If not, the site tree may be
+        # incomplete, so pages are not updated individually
+        self.built = False
+        # incremented after each build; the condition is notified so that
+        # waiting reload requests can respond
+        self.version = 0
+        self.condition = threading.Condition()
+
+    def load_generator(self):
+        config = SiteConfig(self.config_path)
+        if self.jobs is not None:
+            config["jobs"] = config.process_jobs(self.jobs)
+        self.generator = MemorySiteGenerator(config)
+
+    def watched_dirs(self):
+        if self.generator is None:
+            return []
+        return [self.generator.config.content, self.generator.config.theme_dir]
+
+    def take_snapshot(self):
+        """
+        Return a dict mapping path -> (mtime, size) for the config file and
+        every file in the content and theme directories
+        """
+        snapshot = {}
+        try:
+            st = os.stat(self.config_path)
+            snapshot[self.config_path] = (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            pass
+        # scan directories with os.scandir(), which avoids a separate stat()
+        # to tell files and directories apart
+        pending = list(self.watched_dirs())
+        while pending:
+            try:
+                entries = list(os.scandir(pending.pop()))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        pending.append(entry.path)
+                        continue
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                snapshot[entry.path] = (st.st_mtime_ns, st.st_size)
+        return snapshot
+
+    def build(self, reload_config=False):
+        """
+        (Re)build the site, logging errors rather than raising them so that
+        the previous build continues to be served
+        """
+        start = time.perf_counter()
+        self.built = False
+        try:
+            if reload_config or self.generator is None:
+                self.load_generator()
+        except Exception:
+            traceback.print_exc()
+            self.snapshot = self.take_snapshot()
+            return False
+
+        # take the snapshot before building, so that files changed during the
+        # build trigger another one
+        self.snapshot = self.take_snapshot()
+        try:
+            self.generator.gen_site()
+        except Exception:
+            traceback.print_exc()
+            return False
+        self.built = True
+        self.finish_build("Built site", start)
+        return True
+
+    def update(self, paths, snapshot):
+        """
+        Re-render only the pages for the changed content files at `paths`,
+        if possible (see MemorySiteGenerator.update_pages()). `snapshot` is
+        the snapshot in which the changes were found. Return True if the
+        pages were updated, or False if a full build is needed
+        """
+        if not self.built:
+            return False
+        start = time.perf_counter()
+        try:
+            if not self.generator.update_pages(paths):
+                return False
+        except Exception:
+            # the full build reports the error
+            return False
+        self.snapshot = snapshot
+        self.finish_build("Updated {} page(s)".format(len(paths)), start)
+        return True
+
+    def finish_build(self, message, start):
+        """
+        Notify waiting reload requests that a new version of the site is
+        available, and log the time taken since `start`
+        """
+        with self.condition:
+            self.version += 1
+            self.condition.notify_all()
+        print("{} in {:.0f} ms".format(
+            message, (time.perf_counter() - start) * 1000
+        ), file=sys.stderr)
+
+    def check_for_changes(self):
+        """
+        Rebuild the site if any watched files have changed. Return True if a
+        rebuild was attempted
+        """
+        new_snapshot = self.take_snapshot()
+        if new_snapshot == self.snapshot:
+            return False
+        changed = {path for path in set(new_snapshot) | set(self.snapshot)
+                   if new_snapshot.get(path) != self.snapshot.get(path)}
+        if self.config_path in changed:
+            self.build(reload_config=True)
+        elif not self.update(changed, new_snapshot):
+            self.build()
+        return True
+
+    def watch(self):
+        while True:
+            time.sleep(self.interval)
+            self.check_for_changes()
+
+    def wait_for_version(self, version, timeout=30):
+        """
+        Block until the site has been rebuilt since `version`, or until the
+        timeout expires. Return the current version
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version,
+                                    timeout=timeout)
+            return self.version
+
+    def get_response(self, url_path):
+        """
+        Return (body, content type) for a URL path, or None if not found
+        """
+        path = url_path.lstrip("/")
+        files = self.generator.files
+
+        page = os.path.join(path, "index.html")
+        if page in files:
+            script = self.reload_script.format(version=self.version)
+            return files[page] + script.encode("utf-8"), "text/html"
+        if path in files:
+            return files[path], mimetypes.guess_type(path)[0] or "text/plain"
+
+        static_path = self.generator.find_static_file(path)
+        if static_path:
+            with open(static_path, "rb") as f:
+                body = f.read()
+            content_type = mimetypes.guess_type(static_path)[0]
+            return body, content_type or "application/octet-stream"
+        return None
+
+    def make_handler(self):
+        server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url_path, _, query = self.path.partition("?")
+                if url_path == server.reload_path:
+                    version = dict(
+                        p.partition("=")[::2] for p in query.split("&")
+                    ).get("version", "")
+                    try:
+                        version = int(version)
+                    except ValueError:
+                        version = -1
+                    self.respond(
+                        str(server.wait_for_version(version)).encode("utf-8"),
+                        "text/plain"
+                    )
+                    return
+
+                response = server.get_response(url_path)
+                if response is None:
+                    self.send_error(404)
+                    return
+                self.respond(*response)
+
+            def respond(self, body, content_type):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("Cache-Control", "no-store")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return RequestHandler
+
+    def serve_forever(self):
+        if not self.build(reload_config=True):
+            raise SystemExit(1)
+        watcher = threading.Thread(target=self.watch, daemon=True)
+        watcher.start()
+
+        httpd = ThreadingHTTPServer((self.host, self.port), self.make_handler())
+        httpd.daemon_threads = True
+        print("Serving site at http://{}:{}/".format(self.host, self.port),
+              file=sys.stderr)
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
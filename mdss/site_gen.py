@@ -1,26 +1,132 @@
 import os
-import shutil
+import json
+import math
+import queue
+import hashlib
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import meta, TemplateNotFound, TemplateSyntaxError
 
-from mdss.exceptions import NoContentError
+from mdss import stats, highlight
+from mdss.exceptions import NoContentError, MergeError
 from mdss.page import Page, HomePage
-from mdss.tree import SiteTree
+from mdss.tree import SiteTree, NAVIGATION_VARIABLES
 from mdss.macro import MacroHandler
-from mdss.utils import remove_extension
+from mdss.manifest import BuildManifest
+from mdss.static import is_unchanged, export_file
+from mdss.templates import create_environment, is_template
+from mdss.cache import FrontMatterCache
+from mdss.profiling import NullTrace, BuildTrace
+from mdss.minify import minify, minify_chunks
+from mdss.compress import (PRECOMPRESS_FORMATS, is_compressible,
+                           compress_file, gzip_chunks)
+from mdss.sitemap import (MAX_URLS, default_format, part_filename,
+                          text_sitemap, xml_urlset, xml_index)
+from mdss.search import (INDEX_VERSION, INDEX_FILENAME, DOCUMENTS_FILENAME,
+                         MIN_TOKEN_LENGTH, page_text, page_document, shard_filename,
+                         build_index)
+from mdss.utils import (remove_extension, file_signature, file_identity,
+                        file_hash, shard_number)
 from mdss.constants import CONTENT_FILES_EXTENSION
 
 
+# generator used to render pages in a worker process -- see
+# SiteGenerator.render_pages()
+_worker_generator = None
+
+
+def _init_worker(config, tree, trace_origin):
+    """
+    Initialise a worker process with a snapshot of the site. If `trace_origin`
+    is not None, timing spans are recorded relative to it
+    """
+    global _worker_generator
+    _worker_generator = SiteGenerator(config)
+    _worker_generator.tree = tree
+    # forked workers start with a copy of the parent's counters
+    stats.reset()
+    if trace_origin is not None:
+        _worker_generator.trace = BuildTrace(trace_origin)
+
+
+def _render_in_worker(task):
+    """
+    Render a page in a worker process. `task` is (dest path, content, export
+    dir, output). If `output` is None return the result of
+    render_with_template(), and otherwise write the page to `output` and
+    return the template name. Any trace events, the stats counters, the
+    output status and the search document for the page are returned along
+    with the result
+    """
+    dest_path, content, export_dir, output = task
+    page = _worker_generator.tree.get(dest_path)
+    page.content = content
+    if output is None:
+        result = _worker_generator.render_with_template(page)
+    else:
+        result = _worker_generator.render_to_output(page, export_dir, output)
+    status, _worker_generator.output_status = \
+        _worker_generator.output_status, {}
+    documents, _worker_generator.search_documents = \
+        _worker_generator.search_documents, {}
+    return (result, _worker_generator.trace.pop_events(), stats.take(),
+            status, documents)
+
+
+def _render_batch_in_worker(tasks):
+    """
+    Render a list of pages in a worker process, and return a list of the
+    results of _render_in_worker() for each one
+    """
+    return [_render_in_worker(task) for task in tasks]
+
+
 class SiteGenerator:
     """
     Handle generation of the website from source files
     """
+    # size of the write buffer for output files
+    output_buffer_size = 1 << 16
+    # whether worker processes can write pages to the export directory
+    # themselves, rather than sending the HTML back to be written
+    write_in_workers = True
+    # maximum number of pages sent to a worker process at once
+    worker_batch_size = 32
+
     def __init__(self, config):
         self.tree = SiteTree()
         self.config = config
-        self.env = Environment(
-            loader=FileSystemLoader(self.config.theme_dir)
-        )
+        # caches of template name -> template files it depends on, and
+        # template name -> variables it (or any template it uses) reads from
+        # the context
+        self._template_deps = {}
+        self._template_vars = {}
+        # timing spans for build phases and pages are recorded here if it is
+        # replaced with a BuildTrace
+        self.trace = NullTrace()
+        # optional cProfile.Profile to enable while rendering pages
+        self.profiler = None
+        # (shard number, number of shards) if only part of the site should be
+        # exported -- see in_shard()
+        self.shard = None
+        # macro handler shared by all pages, and the config it was created
+        # from
+        self._macro_handler = None
+        self._macro_config = None
+        # map output path -> 'added', 'changed' or 'unchanged' for each file
+        # in the export directory produced by the current build
+        self.output_status = {}
+        # output paths from the previous build that were not produced by the
+        # current one
+        self.removed_outputs = []
+        # map page dest path -> search document (see mdss.search) for each
+        # page in the current build, if a search index is configured
+        self.search_documents = {}
+        self.env = create_environment(self.config)
+        highlight.use_cache_dir(self.config.cache_dir)
 
     @classmethod
     def split_path(cls, path):
@@ -34,62 +140,150 @@ class SiteGenerator:
             return cls.split_path(head) + [tail]
         return cls.split_path(head)
 
-    def add_page(self, page_path):
+    def add_page(self, page_path, cache=None):
         """
         Insert a page at the given source path (relative to content directory)
-        into the site tree
+        into the site tree.
+
+        If a FrontMatterCache is given, the page's context is taken from the
+        cache if the file is unchanged, and the file is not read
         """
         full_path = os.path.join(self.config.content, page_path)
         parts = SiteGenerator.split_path(
             remove_extension(page_path, CONTENT_FILES_EXTENSION)
         )
 
-        # special case for home page
-        if parts == ["index"]:
-            home = HomePage(full_path)
-            self.tree.set_root(home)
-        else:
-            # remove trailing 'index'
-            if parts[-1] == "index":
-                parts.pop(-1)
+        cached = None
+        identity = None
+        context = None
+        content_offset = None
+        if cache is not None:
+            identity = file_identity(full_path)
+            cached = cache.get(full_path, identity)
+            stats.incr("frontmatter_cache_hits" if cached is not None
+                       else "frontmatter_cache_misses")
+            if cached is not None:
+                context, content_offset = cached
+
+        with self.trace.span("add_page", cat="source", path=page_path):
+            # special case for home page
+            if parts == ["index"]:
+                # the page checks the identity of the file again when it
+                # reads the content
+                page = HomePage(full_path, context=context,
+                                content_offset=content_offset,
+                                identity=identity)
+                self.tree.set_root(page)
+            else:
+                # remove trailing 'index'
+                if parts[-1] == "index":
+                    parts.pop(-1)
 
-            page_id = parts[-1]
-            page = Page(page_id, src_path=full_path)
+                page_id = parts[-1]
+                page = Page(page_id, src_path=full_path, context=context,
+                            content_offset=content_offset, identity=identity)
 
-            self.tree.insert(page, location=parts[:-1])
+                self.tree.insert(page, location=parts[:-1])
 
-    def gen_site(self, export_dir):
+        if cache is not None and cached is None:
+            cache.set(full_path, identity, page.context, page.content_offset)
+
+    def gen_site(self, export_dir, force=False):
+        """
+        Find all content and write rendered pages. Pages whose inputs have not
+        changed since the last build are not re-rendered unless `force` is
+        True.
+
+        Counters for the build are kept in mdss.stats, and are reset at the
+        start of each build
+        """
+        stats.reset()
+        self.output_status = {}
+        self.search_documents = {}
+        with self.trace.span("static"):
+            self.export_static(export_dir)
+        with self.trace.span("tree"):
+            self.build_tree()
+        with self.trace.span("render_all"):
+            self.render_all(export_dir, force=force)
+
+    def in_shard(self, output):
+        """
+        Return True if the output at path `output` (relative to the export
+        directory) should be produced by this build. When the build is
+        sharded, pages and static files are split between the shards by a
+        hash of their paths; the site tree and navigation are always built in
+        full so that links between pages are correct
+        """
+        if self.shard is None:
+            return True
+        number, count = self.shard
+        return shard_number(output, count) == number
+
+    def find_static_files(self):
+        """
+        Return a dict mapping path relative to the export directory -> source
+        path for each static file. Where the theme and content directories
+        contain files with the same path, the file in the content directory is
+        used
         """
-        Find all content and write rendered pages
+        static_files = {}
+        for d in [self.config.theme_dir, self.config.content]:
+            for f in self.walk_tree(d, self.config.static_filenames):
+                static_files[f] = os.path.join(d, f)
+        return static_files
+
+    def export_static(self, export_dir):
         """
-        # export static files
-        template_dirs = [self.config.theme_dir, self.config.content]
-        for d in template_dirs:
-            static_files = self.walk_tree(d, self.config.static_filenames)
-            for f in static_files:
-                src = os.path.join(d, f)
-                dest = os.path.join(export_dir, f)
+        Copy static files from the theme and content directories to the
+        export directory. Files that are unchanged since the last export are
+        skipped, and the rest are copied concurrently.
 
-                # make directories if dest dir doesn't not exist
-                dest_dir = os.path.dirname(dest)
-                if not os.path.isdir(dest_dir):
-                    os.makedirs(dest_dir)
+        Return a list of the paths of the files that were copied
+        """
+        mode = self.config.static_copy_mode
+        static_files = {f: src for f, src in self.find_static_files().items()
+                        if self.in_shard(f)}
+        to_copy = [
+            (f, src) for f, src in sorted(static_files.items())
+            if not is_unchanged(src, os.path.join(export_dir, f))
+        ]
+        stats.incr("static_files_copied", len(to_copy))
+        stats.incr("static_files_skipped", len(static_files) - len(to_copy))
+        for f in static_files:
+            self.output_status[f] = "unchanged"
+        for f, _ in to_copy:
+            exists = os.path.lexists(os.path.join(export_dir, f))
+            self.output_status[f] = "changed" if exists else "added"
+        if not to_copy:
+            return []
 
-                shutil.copyfile(src, dest)
+        with ThreadPoolExecutor() as pool:
+            list(pool.map(export_file,
+                          [src for _, src in to_copy],
+                          [os.path.join(export_dir, f) for f, _ in to_copy],
+                          [mode] * len(to_copy)))
+        return [f for f, _ in to_copy]
+
+    def build_tree(self):
+        """
+        Create a new site tree from the content files
+        """
+        self.tree = SiteTree()
+        cache = self.open_frontmatter_cache()
 
-        # build site tree
         content_found = False
         for f in self.walk_tree(self.config.content, [CONTENT_FILES_EXTENSION]):
             content_found = True
-            self.add_page(f)
+            self.add_page(f, cache=cache)
 
         if not content_found:
             raise NoContentError(
                 "Did not find any content .{} files in '{}'"
                 .format(CONTENT_FILES_EXTENSION, self.config.content)
             )
-
-        self.render_all(export_dir)
+        if cache is not None:
+            cache.save()
 
     @classmethod
     def walk_tree(cls, start_dir, extensions):
@@ -101,27 +295,117 @@ class SiteGenerator:
             raise IOError("No such directory '{}'".format(start_dir))
 
         for dirpath, _, filenames in os.walk(start_dir):
+            # work out the relative path once per directory rather than for
+            # every file
+            reldir = os.path.relpath(dirpath, start=start_dir)
             for fname in filenames:
                 ext = os.path.splitext(fname)[1][1:]
                 if ext in extensions:
-                    relpath = os.path.relpath(os.path.join(dirpath, fname),
-                                              start=start_dir)
-                    yield relpath
+                    yield (fname if reldir == os.curdir
+                           else os.path.join(reldir, fname))
 
-    def render_page(self, page):
+    def iter_template_closure(self, name):
         """
-        Return a page HTML as a string
+        Yield (path, parsed template) for template `name` and all templates
+        it extends, includes or imports. Referenced templates that do not
+        exist (e.g. in an 'ignore missing' include, or an include of a list
+        of templates) are yielded with the path they would have and None,
+        so that creating them later is seen as a change
+        """
+        seen = set()
+        # templates that might be used by a dynamic reference. Files among
+        # these that are not valid templates are skipped
+        candidates = set()
+        queue = [name]
+        while queue:
+            t_name = queue.pop()
+            if t_name in seen:
+                continue
+            seen.add(t_name)
+            try:
+                source, path, _ = self.env.loader.get_source(self.env, t_name)
+                ast = self.env.parse(source)
+            except TemplateNotFound:
+                if t_name == name:
+                    raise
+                yield os.path.join(self.config.theme_dir,
+                                   *t_name.split("/")), None
+                continue
+            except (UnicodeDecodeError, TemplateSyntaxError):
+                if t_name in candidates:
+                    continue
+                raise
+            yield path, ast
+            for ref in meta.find_referenced_templates(ast):
+                if ref is None:
+                    # template name is only known at render time, so assume
+                    # every template could be used
+                    names = self.env.list_templates(
+                        filter_func=lambda n: is_template(self.config, n)
+                    )
+                    candidates.update(names)
+                    queue.extend(names)
+                else:
+                    queue.append(ref)
+
+    def template_dependencies(self, name):
+        """
+        Return a list of paths to the files for template `name` and all
+        templates it extends, includes or imports
+        """
+        if name not in self._template_deps:
+            self._template_deps[name] = sorted(
+                path for path, _ in self.iter_template_closure(name)
+            )
+        return self._template_deps[name]
+
+    def template_variables(self, name):
+        """
+        Return the set of context variables that template `name`, or any
+        template it extends, includes or imports, may use
+        """
+        if name not in self._template_vars:
+            variables = set()
+            for _, ast in self.iter_template_closure(name):
+                if ast is not None:
+                    variables |= meta.find_undeclared_variables(ast)
+            self._template_vars[name] = variables
+        return self._template_vars[name]
+
+    def get_macro_handler(self):
+        """
+        Return the MacroHandler used for all pages, so that macros are only
+        compiled once per build (or when the macros config changes)
+        """
+        macro_config = (self.config.macros, tuple(self.config.pure_macros))
+        if self._macro_config != macro_config:
+            self._macro_handler = MacroHandler(self.config.macros, "<macro>",
+                                               pure=self.config.pure_macros)
+            self._macro_config = macro_config
+        return self._macro_handler
+
+    def prepare_page(self, page):
+        """
+        Return (template, context) for rendering a page
         """
         context = {}
         context.update(self.config.default_context)
-        p_context, content = page.read_page_source()
+        with self.trace.span("read", cat="render"):
+            p_context, content = page.get_source()
         # modify context
         context.update(p_context)
 
         if self.config.macros:
-            macro_handler = MacroHandler(self.config.macros, "<macro>")
-            content = macro_handler.replace_all(content)
-        context.update(content=Page.content_to_html(content))
+            with self.trace.span("macros", cat="render"):
+                content = self.get_macro_handler().replace_all(content)
+        with self.trace.span("markdown", cat="render"):
+            context.update(content=Page.content_to_html(
+                content, search=bool(self.config.search_index)
+            ))
+        if self.config.search_index:
+            # index the text of the converted document while it is at hand
+            headings, text = page_text(Page.get_markdown(search=True))
+        page.release_content()
 
         if "template" not in context:
             context["template"] = self.config.default_template
@@ -130,37 +414,583 @@ class SiteGenerator:
             context["title"] = page.title
 
         context["path"] = page.dest_path
-        context["breadcrumbs"] = page.breadcrumbs
-        context["children"] = page.child_listing()
-        context["sitemap"] = self.tree.root.child_listing()
-        context["siblings"] = page.parent.child_listing() if page.parent else []
-
+        if self.config.search_index:
+            with self.trace.span("search", cat="render"):
+                self.search_documents[page.dest_path] = page_document(
+                    page.dest_path[1:], str(context["title"]), headings, text
+                )
         template = self.env.get_template(context.pop("template"))
-        return template.render(**context)
 
-    def render_all(self, export_dir):
+        # only compute the navigation variables the template actually uses
+        used = self.template_variables(template.name) & NAVIGATION_VARIABLES
+        if "breadcrumbs" in used:
+            context["breadcrumbs"] = page.breadcrumbs
+        if used - {"breadcrumbs"}:
+            nav = self.tree.navigation
+            if "children" in used:
+                context["children"] = nav.children(page)
+            if "sitemap" in used:
+                context["sitemap"] = nav.sitemap
+            if "siblings" in used:
+                context["siblings"] = nav.siblings(page)
+        return template, context
+
+    def render_page(self, page):
+        """
+        Return a page HTML as a string
+        """
+        return self.render_with_template(page)[0]
+
+    def render_with_template(self, page):
+        """
+        Return (html, template name) for a page
+        """
+        with self.trace.span(page.dest_path, cat="page"):
+            template, context = self.prepare_page(page)
+            with self.trace.span("template", cat="render",
+                                 template=template.name):
+                html = template.render(**context)
+            if self.config.minify_html:
+                with self.trace.span("minify", cat="render"):
+                    html = minify(html)
+        stats.incr("template_renders")
+        return html, template.name
+
+    def render_to_output(self, page, export_dir, output):
+        """
+        Render a page and write it to `output` (relative to the export
+        directory) as it is generated, so that the full HTML is never held in
+        memory. Return the template name
+        """
+        with self.trace.span(page.dest_path, cat="page"):
+            template, context = self.prepare_page(page)
+            self.write_page(template, context, export_dir, output)
+        return template.name
+
+    def write_page(self, template, context, export_dir, output):
+        """
+        Render a template and stream the result to `output`
+        """
+        with self.trace.span("template", cat="render", template=template.name):
+            # rendering (and minification) happens as the output is written
+            with self.trace.span("write", cat="write", path=output):
+                chunks = template.generate(**context)
+                if self.config.minify_html:
+                    chunks = minify_chunks(chunks)
+                self.write_output(export_dir, output, chunks)
+        stats.incr("template_renders")
+
+    def pipeline_pages(self, pages, export_dir, outputs):
+        """
+        Render pages and write them to their outputs in three overlapping
+        stages: a reader thread loads page sources ahead of time, this thread
+        converts them (macros and Markdown), and a pool of `io_threads` writer
+        threads renders the templates into the output files. Queues between
+        the stages are bounded, so only a few pages are held in memory at
+        once.
+
+        Yield the template name for each page, in order
+        """
+        depth = 2 * self.config.io_threads
+        sources = queue.Queue(maxsize=depth)
+        stop = threading.Event()
+
+        def write(page, template, context, output):
+            # rendering and writing are part of the page's time, along with
+            # the conversion in this thread
+            with self.trace.span(page.dest_path, cat="page"):
+                self.write_page(template, context, export_dir, output)
+
+        def read():
+            try:
+                for page in pages:
+                    if stop.is_set():
+                        return
+                    with self.trace.span("prefetch", cat="source",
+                                         path=page.dest_path):
+                        page.get_source()
+                    sources.put(page)
+            except BaseException as ex:
+                sources.put(ex)
+
+        reader = threading.Thread(target=read, name="mdss-reader",
+                                  daemon=True)
+        reader.start()
+        in_flight = deque()
+        try:
+            with ThreadPoolExecutor(self.config.io_threads,
+                                    thread_name_prefix="mdss-writer") as pool:
+                for output in outputs:
+                    page = sources.get()
+                    if isinstance(page, BaseException):
+                        raise page
+                    with self.trace.span(page.dest_path, cat="page"):
+                        template, context = self.prepare_page(page)
+                    in_flight.append((template.name, pool.submit(
+                        write, page, template, context, output
+                    )))
+                    if len(in_flight) >= depth:
+                        name, future = in_flight.popleft()
+                        future.result()
+                        yield name
+                while in_flight:
+                    name, future = in_flight.popleft()
+                    future.result()
+                    yield name
+        finally:
+            # let the reader finish if it is blocked on a full queue
+            stop.set()
+            while reader.is_alive():
+                try:
+                    sources.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    def render_pages(self, pages, export_dir=None, outputs=None):
         """
-        Render each page in the tree and write it to a file, and optionally
-        create a plain text sitemap file listing all URLs
+        Render a list of pages and yield (html, template name) for each one in
+        order. If a list of `outputs` is given, each page is instead written
+        to the corresponding output in `export_dir` as it is rendered, and the
+        template name is yielded.
+
+        If more than one job is configured the pages are rendered in a pool
+        of worker processes, each with its own copy of the site tree. When
+        rendering in a single process, pages are pipelined with
+        pipeline_pages() unless a profiler is active, since cProfile only
+        sees the main thread
+        """
+        if outputs is None:
+            outputs = [None] * len(pages)
+
+        jobs = self.config.jobs
+        if (jobs <= 1 and self.config.io_threads > 0 and len(pages) > 1
+                and None not in outputs and self.profiler is None):
+            yield from self.pipeline_pages(pages, export_dir, outputs)
+            return
+        if jobs <= 1 or len(pages) <= 1:
+            for page, output in zip(pages, outputs):
+                if output is None:
+                    yield self.render_with_template(page)
+                else:
+                    yield self.render_to_output(page, export_dir, output)
+            return
+
+        in_workers = self.write_in_workers
+        batch_size = max(1, min(len(pages) // (jobs * 4),
+                                self.worker_batch_size))
+
+        def batches():
+            # send each page's content along with the page to render, and
+            # release it here once it has been handed to the pool
+            items = list(zip(pages, outputs))
+            for start in range(0, len(items), batch_size):
+                batch = items[start:start + batch_size]
+                tasks = [(page.dest_path, page.get_source()[1], export_dir,
+                          output if in_workers else None)
+                         for page, output in batch]
+                for page, _ in batch:
+                    page.release_content()
+                yield [output for _, output in batch], tasks
+
+        def handle(outputs, future):
+            for output, (result, events, counts, status,
+                         documents) in zip(outputs, future.result()):
+                self.trace.add_events(events)
+                stats.merge(counts)
+                self.output_status.update(status)
+                self.search_documents.update(documents)
+                if output is not None and not in_workers:
+                    html, result = result
+                    with self.trace.span("write", cat="write", path=output):
+                        self.write_output(export_dir, output, html)
+                yield result
+
+        trace_origin = self.trace.origin if self.trace.enabled else None
+        # only a few batches are submitted at a time, so that the content of
+        # every page is not read into memory before any results come back
+        depth = 2 * jobs
+        in_flight = deque()
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                 initargs=(self.config, self.tree,
+                                           trace_origin)) as pool:
+            for batch_outputs, tasks in batches():
+                in_flight.append((batch_outputs, pool.submit(
+                    _render_batch_in_worker, tasks
+                )))
+                if len(in_flight) >= depth:
+                    yield from handle(*in_flight.popleft())
+            while in_flight:
+                yield from handle(*in_flight.popleft())
+
+    def render_all(self, export_dir, force=False):
+        """
+        Render each page in the tree and write it to a file, optionally create
+        a sitemap file listing all URLs and a search index, and write
+        precompressed copies of the output if configured.
+
+        A manifest of the inputs used for each page is kept so that pages are
+        only re-rendered when their source, templates, the site config or the
+        parts of the site navigation their templates use change (or when
+        `force` is True). The search document
+        for each page is kept in the manifest so that skipped pages are still
+        indexed. The manifest also lists every output file, so that files
+        removed since the previous build can be reported by output_changes()
         """
-        paths = []
+        manifest = self.open_manifest(export_dir)
+        self._template_deps = {}
+        self._template_vars = {}
+        config_hash = self.config.fingerprint()
+        with self.trace.span("navigation"):
+            nav = self.tree.navigation
+
+        pending = []
         for page in self.tree:
-            html = self.render_page(page)
             # remove leading / from path
-            path = page.dest_path[1:]
-            paths.append(path)
-            dest_path = os.path.join(export_dir, path, "index.html")
-
-            # make sure containing directory exists
-            par_dir = os.path.dirname(dest_path)
-            if not os.path.isdir(par_dir):
-                os.makedirs(par_dir)
-            with open(dest_path, "w") as f:
-                f.write(html)
-
-        if self.config.sitemap_file:
-            base_url = self.config.sitemap_file["base_url"]
-            filename = self.config.sitemap_file["filename"]
-            outpath = os.path.join(export_dir, filename)
-            with open(outpath, "w", encoding="utf-8") as f:
-                f.writelines("{}/{}\n".format(base_url, path) for path in paths)
+            output = os.path.join(page.dest_path[1:], "index.html")
+            if not self.in_shard(output):
+                page.release_content()
+                continue
+
+            inputs = {
+                "source": page.src_path and file_signature(page.src_path),
+                "config": config_hash,
+                "navigation": nav.fingerprint(
+                    page, self.navigation_variables(page)
+                )
+            }
+            if (not force and manifest.is_current(output, **inputs)
+                    and self.output_exists(export_dir, output)):
+                manifest.keep(output)
+                self.output_status[output] = "unchanged"
+                document = manifest.get_data(output).get("search")
+                if document is not None:
+                    self.search_documents[page.dest_path] = document
+                page.release_content()
+                stats.incr("manifest_hits")
+                continue
+            stats.incr("manifest_misses")
+            pending.append((page, output, inputs))
+
+        if self.profiler is not None:
+            self.profiler.enable()
+        try:
+            rendered = self.render_pages([page for page, _, _ in pending],
+                                         export_dir,
+                                         [output for _, output, _ in pending])
+            for (page, output, inputs), template_name in zip(pending,
+                                                              rendered):
+                data = {}
+                if page.dest_path in self.search_documents:
+                    data["search"] = self.search_documents[page.dest_path]
+                manifest.add(output, self.template_dependencies(template_name),
+                             data=data, **inputs)
+        finally:
+            if self.profiler is not None:
+                self.profiler.disable()
+
+        # the sitemap and search index for a sharded build are written when
+        # the shards are merged
+        if self.shard is None:
+            self.write_sitemap(export_dir)
+            with self.trace.span("search_index"):
+                self.write_search_index(export_dir)
+        elif self.config.search_index:
+            self.write_search_documents(export_dir)
+
+        with self.trace.span("precompress"):
+            self.precompress(export_dir)
+
+        self.removed_outputs = sorted(
+            set(manifest.previous_files) - set(self.output_status)
+        )
+        manifest.files = list(self.output_status)
+        manifest.save()
+
+    def navigation_variables(self, page):
+        """
+        Return the set of navigation variables used by the template for
+        `page`, without reading the page's content
+        """
+        context = dict(self.config.default_context)
+        context.update(page.context)
+        name = context.get("template", self.config.default_template)
+        return self.template_variables(name) & NAVIGATION_VARIABLES
+
+    def sitemap_entries(self):
+        """
+        Yield (path, modification time of source file or None) for each page
+        in the tree
+        """
+        for page in self.tree:
+            mtime = None
+            if page.src_path:
+                try:
+                    mtime = os.path.getmtime(page.src_path)
+                except OSError:
+                    pass
+            yield page.dest_path[1:], mtime
+
+    def precompress(self, export_dir):
+        """
+        Write compressed copies (e.g. index.html.gz) of each compressible
+        output file produced by the last build, in each of the formats listed
+        in the `precompress` config option, so that web servers can serve them
+        without compressing on the fly. Files are compressed concurrently, and
+        compressed files that are already up to date are skipped
+        """
+        tasks = [
+            (output, output + PRECOMPRESS_FORMATS[fmt], fmt)
+            for output in sorted(self.output_status) if is_compressible(output)
+            for fmt in self.config.precompress
+        ]
+        if not tasks:
+            return
+
+        def compress(task):
+            output, compressed, fmt = task
+            return compress_file(os.path.join(export_dir, output),
+                                 os.path.join(export_dir, compressed), fmt)
+
+        with ThreadPoolExecutor() as pool:
+            statuses = list(pool.map(compress, tasks))
+        for (_, compressed, _), status in zip(tasks, statuses):
+            self.output_status[compressed] = status
+            stats.incr("precompress_skipped" if status == "unchanged"
+                       else "precompressed_files")
+
+    def write_sitemap(self, export_dir):
+        """
+        Write the sitemap file listing the URL of each page, if a sitemap file
+        is configured. Sitemaps are written in plain text or XML format,
+        optionally gzipped, and are streamed to the output file as the tree is
+        traversed.
+
+        XML sitemaps with more than `max_urls` URLs are split into numbered
+        files, and `filename` is written as a sitemap index listing them
+        """
+        settings = self.config.sitemap_file
+        if not settings:
+            return
+        base_url = settings["base_url"]
+        filename = settings["filename"]
+        compress = settings.get("gzip", filename.endswith(".gz"))
+
+        def write(name, chunks):
+            if compress:
+                chunks = gzip_chunks(chunks)
+            self.write_output(export_dir, name, chunks)
+
+        entries = self.sitemap_entries()
+        if settings.get("format", default_format(filename)) == "text":
+            write(filename, text_sitemap(base_url, entries))
+            return
+
+        max_urls = settings.get("max_urls", MAX_URLS)
+        if len(self.tree.pages) <= max_urls:
+            write(filename, xml_urlset(base_url, entries))
+            return
+
+        parts = []
+        for number in range(1, math.ceil(len(self.tree.pages) / max_urls) + 1):
+            name = part_filename(filename, number)
+            modified = []
+            write(name, xml_urlset(base_url,
+                                   itertools.islice(entries, max_urls),
+                                   modified))
+            parts.append((name, modified[0]))
+        write(filename, xml_index(base_url, parts))
+
+    def write_search_index(self, export_dir):
+        """
+        Write the search index for the pages in the tree, if one is
+        configured. The index is split into shards by the first
+        `prefix_length` characters of each term, so that a search only needs
+        to load the shards for the terms searched for. The index file lists
+        the pages and the filename of each shard
+        """
+        settings = self.config.search_index
+        if not settings:
+            return
+        directory = settings["directory"]
+        prefix_length = settings["prefix_length"]
+
+        documents = [self.search_documents[page.dest_path]
+                     for page in self.tree
+                     if page.dest_path in self.search_documents]
+        index = build_index(documents, prefix_length)
+        shards = {}
+        for prefix, terms in sorted(index.items()):
+            shards[prefix] = shard_filename(prefix)
+            self.write_output(
+                export_dir, os.path.join(directory, shards[prefix]),
+                json.dumps(terms, sort_keys=True, ensure_ascii=False,
+                           separators=(",", ":"))
+            )
+            stats.incr("search_terms", len(terms))
+        stats.incr("search_documents", len(documents))
+
+        self.write_output(export_dir, os.path.join(directory, INDEX_FILENAME),
+                          json.dumps({
+                              "version": INDEX_VERSION,
+                              "prefix_length": prefix_length,
+                              "min_token_length": MIN_TOKEN_LENGTH,
+                              "documents": [[d["path"], d["title"]]
+                                            for d in documents],
+                              "shards": shards,
+                          }, ensure_ascii=False, separators=(",", ":")))
+
+    def write_search_documents(self, export_dir):
+        """
+        Write the search documents for the pages in a shard to the shard's
+        export directory, so that they can be found by merge_shards()
+        whatever machine the shard was built on
+        """
+        path = os.path.join(export_dir, DOCUMENTS_FILENAME)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.search_documents, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def merge_shards(self, export_dir, shard_dirs):
+        """
+        Combine the export directories of a sharded build into `export_dir`
+        (which may itself be one of the shard directories) and write the
+        sitemap file and search index. The search documents for the pages are
+        read from the file written by write_search_documents() in each shard.
+        Raise MergeError if any page is missing from all the shards, or has
+        no search document when a search index is configured.
+
+        Return a list of the paths of the files that were copied
+        """
+        copied = []
+        mode = self.config.static_copy_mode
+        self.search_documents = {}
+        for shard_dir in shard_dirs:
+            if self.config.search_index:
+                try:
+                    path = os.path.join(shard_dir, DOCUMENTS_FILENAME)
+                    with open(path, encoding="utf-8") as f:
+                        self.search_documents.update(json.load(f))
+                except FileNotFoundError:
+                    pass
+            if os.path.abspath(shard_dir) == os.path.abspath(export_dir):
+                continue
+            for dirpath, _, filenames in os.walk(shard_dir):
+                for fname in filenames:
+                    if fname in (BuildManifest.filename, DOCUMENTS_FILENAME):
+                        continue
+                    src = os.path.join(dirpath, fname)
+                    output = os.path.relpath(src, shard_dir)
+                    dest = os.path.join(export_dir, output)
+                    if not is_unchanged(src, dest):
+                        export_file(src, dest, mode)
+                        copied.append(output)
+
+        self.build_tree()
+        missing = [
+            page.dest_path for page in self.tree
+            if not os.path.isfile(os.path.join(export_dir, page.dest_path[1:],
+                                               "index.html"))
+        ]
+        if missing:
+            raise MergeError("Pages missing from shard outputs: {}"
+                             .format(", ".join(missing)))
+        if self.config.search_index:
+            unindexed = [page.dest_path for page in self.tree
+                         if page.dest_path not in self.search_documents]
+            if unindexed:
+                raise MergeError("Search documents missing from shards: {}"
+                                 .format(", ".join(unindexed)))
+        self.write_sitemap(export_dir)
+        self.write_search_index(export_dir)
+        return sorted(copied)
+
+    def output_changes(self):
+        """
+        Return a dict listing the output files added, changed and removed by
+        the last build (relative to the export directory), e.g. so that only
+        these need to be uploaded when deploying the site
+        """
+        changes = {"added": [], "changed": [], "removed": self.removed_outputs}
+        for output, status in sorted(self.output_status.items()):
+            if status in changes:
+                changes[status].append(output)
+        return changes
+
+    def open_manifest(self, export_dir):
+        """
+        Return the build manifest for an export directory
+        """
+        return BuildManifest(
+            BuildManifest.location(export_dir, self.config.cache_dir)
+        )
+
+    def open_frontmatter_cache(self):
+        """
+        Return the FrontMatterCache to use when building the tree, or None
+        """
+        if not self.config.cache_dir:
+            return None
+        return FrontMatterCache(
+            FrontMatterCache.location(self.config.cache_dir)
+        )
+
+    def output_exists(self, export_dir, output):
+        """
+        Return True if the output file at path `output` (relative to the
+        export directory) exists
+        """
+        return os.path.isfile(os.path.join(export_dir, output))
+
+    def write_output(self, export_dir, output, text):
+        """
+        Write an output file at path `output` relative to the export
+        directory. `text` is either a string or an iterable of strings (e.g.
+        from template.generate()) or bytes, which are written as they are
+        produced.
+
+        The file is written to a temporary file first and then renamed into
+        place, so that a partially written file is never seen. If the existing
+        file already has identical contents it is left untouched, so that its
+        modification time does not change
+        """
+        dest_path = os.path.join(export_dir, output)
+        # make sure containing directory exists. Other writer threads may be
+        # creating the same directory
+        par_dir = os.path.dirname(dest_path)
+        if not os.path.isdir(par_dir):
+            os.makedirs(par_dir, exist_ok=True)
+        if isinstance(text, (str, bytes)):
+            text = (text,)
+
+        tmp_path = dest_path + ".tmp"
+        checksum = hashlib.sha1()
+        size = 0
+        try:
+            with open(tmp_path, "wb", buffering=self.output_buffer_size) as f:
+                for chunk in text:
+                    data = (chunk if isinstance(chunk, bytes)
+                            else chunk.encode("utf-8"))
+                    checksum.update(data)
+                    f.write(data)
+                    size += len(data)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        stats.incr("bytes_written", size)
+
+        try:
+            existing_size = os.path.getsize(dest_path)
+        except OSError:
+            existing_size = None
+        if (existing_size == size
+                and file_hash(dest_path) == checksum.hexdigest()):
+            os.remove(tmp_path)
+            self.output_status[output] = "unchanged"
+            stats.incr("outputs_unchanged")
+            return
+
+        os.replace(tmp_path, dest_path)
+        self.output_status[output] = ("added" if existing_size is None
+                                      else "changed")
+        stats.incr("files_written")
@@ -0,0 +1,92 @@
+import os
+import time
+from urllib.parse import quote
+from xml.sax.saxutils import escape
+
+
+SITEMAP_NAMESPACE = "http://www.sitemaps.org/schemas/sitemap/0.9"
+
+# maximum number of URLs allowed in a single sitemap file
+MAX_URLS = 50000
+
+SITEMAP_FORMATS = ["text", "xml"]
+
+
+def default_format(filename):
+    """
+    Return the sitemap format implied by a filename
+    """
+    if filename.endswith(".gz"):
+        filename = filename[:-len(".gz")]
+    return "xml" if filename.endswith(".xml") else "text"
+
+
+def part_filename(filename, number):
+    """
+    Return the filename of the `number`-th part of a split sitemap, e.g.
+    sitemap.xml.gz -> sitemap-1.xml.gz
+    """
+    directory, base = os.path.split(filename)
+    stem, dot, ext = base.partition(".")
+    return os.path.join(directory, "{}-{}{}{}".format(stem, number, dot, ext))
+
+
+def lastmod(timestamp):
+    """
+    Format a Unix timestamp as a W3C datetime for <lastmod>
+    """
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(timestamp))
+
+
+def page_url(base_url, path):
+    return "{}/{}".format(base_url, quote(path, safe="/"))
+
+
+def text_sitemap(base_url, entries):
+    """
+    Yield the lines of a plain text sitemap. `entries` is an iterable of
+    (path, modification time or None)
+    """
+    for path, _ in entries:
+        yield "{}/{}\n".format(base_url, path)
+
+
+def xml_urlset(base_url, entries, modified=None):
+    """
+    Yield chunks of an XML sitemap listing `entries`, an iterable of (path,
+    modification time or None). If `modified` is given, the latest
+    modification time seen is appended to it
+    """
+    latest = None
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<urlset xmlns="{}">\n'.format(SITEMAP_NAMESPACE))
+    for path, mtime in entries:
+        loc = escape(page_url(base_url, path))
+        if mtime is None:
+            yield "<url><loc>{}</loc></url>\n".format(loc)
+        else:
+            yield "<url><loc>{}</loc><lastmod>{}</lastmod></url>\n".format(
+                loc, lastmod(mtime)
+            )
+            if latest is None or mtime > latest:
+                latest = mtime
+    yield "</urlset>\n"
+    if modified is not None:
+        modified.append(latest)
+
+
+def xml_index(base_url, parts):
+    """
+    Yield chunks of a sitemap index. `parts` is a list of (filename of a
+    sitemap, latest modification time of its pages or None)
+    """
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<sitemapindex xmlns="{}">\n'.format(SITEMAP_NAMESPACE))
+    for filename, mtime in parts:
+        loc = escape(page_url(base_url, filename.replace(os.sep, "/")))
+        if mtime is None:
+            yield "<sitemap><loc>{}</loc></sitemap>\n".format(loc)
+        else:
+            yield ("<sitemap><loc>{}</loc><lastmod>{}</lastmod></sitemap>\n"
+                   .format(loc, lastmod(mtime)))
+    yield "</sitemapindex>\n"
@@ -0,0 +1,78 @@
+import os
+import shutil
+import filecmp
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+
+# ioctl request to clone a file's extents on Linux (see ioctl_ficlone(2))
+FICLONE = 0x40049409
+
+COPY_MODES = ["copy", "hardlink", "reflink"]
+
+
+def is_unchanged(src, dest):
+    """
+    Return True if `dest` already has the same contents as `src`. Files of the
+    same size and modification time are assumed to be identical; otherwise
+    files of the same size are compared byte by byte
+    """
+    try:
+        src_st = os.stat(src)
+        dest_st = os.stat(dest)
+    except FileNotFoundError:
+        return False
+    if src_st.st_size != dest_st.st_size:
+        return False
+    if src_st.st_mtime_ns == dest_st.st_mtime_ns:
+        return True
+    if filecmp.cmp(src, dest, shallow=False):
+        # update the mtime so that the next check only needs to stat
+        shutil.copystat(src, dest)
+        return True
+    return False
+
+
+def reflink(src, dest):
+    """
+    Create `dest` as a copy-on-write clone of `src`. Raise OSError if the
+    filesystem does not support this
+    """
+    if fcntl is None:
+        raise OSError("reflinks are not supported on this platform")
+    with open(src, "rb") as src_f, open(dest, "wb") as dest_f:
+        fcntl.ioctl(dest_f.fileno(), FICLONE, src_f.fileno())
+    shutil.copystat(src, dest)
+
+
+def export_file(src, dest, mode="copy"):
+    """
+    Export a static file by copying, hard linking or reflinking it, falling
+    back to a plain copy if a link cannot be created. Modification times are
+    preserved so that unchanged files can be detected in later builds
+    """
+    dest_dir = os.path.dirname(dest)
+    if not os.path.isdir(dest_dir):
+        os.makedirs(dest_dir, exist_ok=True)
+    # remove any existing file rather than writing over it, in case it is a
+    # hard link to a source file
+    if os.path.lexists(dest):
+        os.remove(dest)
+
+    if mode == "hardlink":
+        try:
+            os.link(src, dest)
+            return
+        except OSError:
+            pass
+    elif mode == "reflink":
+        try:
+            reflink(src, dest)
+            return
+        except OSError:
+            if os.path.lexists(dest):
+                os.remove(dest)
+    shutil.copy2(src, dest)
@@ -0,0 +1,68 @@
+import sys
+import json
+import threading
+from collections import Counter
+
+try:
+    import resource
+except ImportError:  # pragma: no cover - not available on Windows
+    resource = None
+
+
+# counters for the build in progress in this process. These are module-level
+# so that they are cheap to update from anywhere in the pipeline
+counters = Counter()
+# counters may be updated from the reader and writer threads of a pipelined
+# build
+_lock = threading.Lock()
+
+
+def incr(name, n=1):
+    with _lock:
+        counters[name] += n
+
+
+def reset():
+    counters.clear()
+
+
+def take():
+    """
+    Return the current counters and reset them. Used to send counts from
+    worker processes back to the main process
+    """
+    counts = dict(counters)
+    counters.clear()
+    return counts
+
+
+def merge(counts):
+    counters.update(counts)
+
+
+def peak_rss():
+    """
+    Return (peak RSS of this process, peak RSS of the largest child process)
+    in bytes, or (None, None) if this is not available
+    """
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kilobytes on Linux but bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return own, children
+
+
+def report():
+    """
+    Return a dict of the current counters and peak memory usage
+    """
+    stats = dict(sorted(counters.items()))
+    stats["peak_rss_bytes"], stats["peak_child_rss_bytes"] = peak_rss()
+    return stats
+
+
+def write_report(path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report(), f, indent=2)
@@ -0,0 +1,115 @@
+import os
+import json
+import hashlib
+
+from jinja2 import (Environment, BaseLoader, FileSystemLoader, ModuleLoader,
+                    FileSystemBytecodeCache, TemplateNotFound,
+                    TemplateSyntaxError)
+
+
+def source_checksum(source):
+    return hashlib.sha1(source.encode("utf-8")).hexdigest()
+
+
+def is_template(config, name):
+    """
+    Return True if file `name` in the theme directory may be a template,
+    i.e. it is not a static file
+    """
+    ext = os.path.splitext(name)[1][1:]
+    return ext not in config.static_filenames
+
+
+class CompiledThemeLoader(BaseLoader):
+    """
+    Loader that uses templates precompiled by compile_theme() where they are
+    up to date, and otherwise loads and compiles templates from the theme
+    directory
+    """
+
+    # file in the compiled theme directory mapping template name -> checksum
+    # of the source it was compiled from
+    index_filename = "index.json"
+
+    def __init__(self, theme_dir, compiled_dir):
+        self.source_loader = FileSystemLoader(theme_dir)
+        self.module_loader = ModuleLoader(compiled_dir)
+        try:
+            index_path = os.path.join(compiled_dir, self.index_filename)
+            with open(index_path, encoding="utf-8") as f:
+                self.checksums = json.load(f)
+        except (IOError, ValueError):
+            self.checksums = {}
+
+    def get_source(self, environment, template):
+        return self.source_loader.get_source(environment, template)
+
+    def list_templates(self):
+        return self.source_loader.list_templates()
+
+    def load(self, environment, name, globals=None):
+        source, _, uptodate = self.get_source(environment, name)
+        if self.checksums.get(name) == source_checksum(source):
+            try:
+                template = self.module_loader.load(environment, name, globals)
+            except TemplateNotFound:
+                pass
+            else:
+                # templates loaded from modules are otherwise always
+                # considered up to date, so changes to the theme would not be
+                # seen when the environment is reused
+                template._uptodate = uptodate
+                return template
+        return super().load(environment, name, globals)
+
+
+def create_environment(config):
+    """
+    Create the jinja2 environment for a site. If `cache_dir` is set compiled
+    templates are cached on disk, and if `compiled_theme` is set templates
+    precompiled by compile_theme() are used where possible
+    """
+    if config.compiled_theme:
+        loader = CompiledThemeLoader(config.theme_dir, config.compiled_theme)
+    else:
+        loader = FileSystemLoader(config.theme_dir)
+
+    bytecode_cache = None
+    if config.cache_dir:
+        cache_path = os.path.join(config.cache_dir, "jinja")
+        os.makedirs(cache_path, exist_ok=True)
+        bytecode_cache = FileSystemBytecodeCache(cache_path)
+
+    return Environment(loader=loader, bytecode_cache=bytecode_cache)
+
+
+def compile_theme(config, target):
+    """
+    Compile each template in the theme directory to a Python module in
+    `target`, for use with the `compiled_theme` config option. Static files
+    and files that are not valid templates are skipped.
+
+    Return a list of the names of the templates compiled
+    """
+    env = Environment(loader=FileSystemLoader(config.theme_dir))
+    os.makedirs(target, exist_ok=True)
+
+    checksums = {}
+    for name in env.list_templates(
+            filter_func=lambda name: is_template(config, name)):
+        try:
+            source, filename, _ = env.loader.get_source(env, name)
+            code = env.compile(source, name, filename, raw=True,
+                               defer_init=True)
+        except (UnicodeDecodeError, TemplateSyntaxError):
+            continue
+        module_path = os.path.join(target,
+                                   ModuleLoader.get_module_filename(name))
+        with open(module_path, "w", encoding="utf-8") as f:
+            f.write(code)
+        checksums[name] = source_checksum(source)
+
+    index_path = os.path.join(target, CompiledThemeLoader.index_filename)
+    with open(index_path, "w", encoding="utf-8") as f:
+        json.dump(checksums, f, indent=2, sort_keys=True)
+    return sorted(checksums)
@@ -1,15 +1,40 @@
 import time
 import os
+import gzip
+import json
+import random
+import cProfile
+import pstats
+import threading
+from xml.etree import ElementTree
 
 import yaml
 import pytest
+import markdown
+from jinja2 import ModuleLoader
 from py.path import local
 
 from mdss.site_gen import SiteGenerator
-from mdss.tree import SiteTree
+from mdss.tree import SiteTree, Navigation
 from mdss.config import BaseConfig, SiteConfig, ConfigOption
 from mdss.page import Page, HomePage, PageInfo, cachedproperty
-from mdss.exceptions import InvalidPageError, NoContentError
+from mdss.manifest import BuildManifest
+from mdss.cache import FrontMatterCache
+from mdss.highlight import HighlightCache
+from mdss.sitemap import SITEMAP_NAMESPACE
+from mdss.compress import brotli
+from mdss.minify import minify, minify_chunks
+from mdss.search import (tokenize, page_document, build_index, shard_filename,
+                         page_text, DOCUMENTS_FILENAME)
+from mdss.utils import file_identity
+from mdss.benchmark import (generate_site, run_benchmark, generate_body,
+                            page_location)
+from mdss.profiling import BuildTrace
+from mdss import stats, highlight
+from mdss.serve import DevServer, MemorySiteGenerator
+from mdss.static import COPY_MODES
+from mdss.templates import compile_theme
+from mdss.exceptions import InvalidPageError, NoContentError, MergeError
 
 class BaseTest:
     @pytest.fixture
@@ -39,6 +64,26 @@ class BaseTest:
         f.write(yaml.dump(kwargs))
         return cls(str(f))
 
+    def create_pages(self, content, count):
+        """
+        Write `count` content files p0.md, p1.md, ... with a title, a heading
+        and some text, and modification times one second apart
+        """
+        for i in range(count):
+            page = content.join("p{}.md".format(i))
+            page.write("title: page {}\n---\n# Page {}\n\ntext".format(i, i))
+            os.utime(str(page), (1000000000 + i, 1000000000 + i))
+
+    def read_outputs(self, directory, pattern="*"):
+        """
+        Return a dict mapping path relative to `directory` -> contents for
+        each exported file matching `pattern`, excluding the build manifest
+        and the search documents of a shard
+        """
+        return {f.relto(directory): f.read() for f in directory.visit(pattern)
+                if f.isfile() and f.basename not in (BuildManifest.filename,
+                                                     DOCUMENTS_FILENAME)}
+
 
 class TestSiteGeneration(BaseTest):
 
@@ -86,6 +131,7 @@ class TestSiteGeneration(BaseTest):
                 all_files.append(os.path.relpath(path, start=str(output)))
 
         assert set(all_files) == set([
+            BuildManifest.filename,
             "index.html",
             "blog/index.html",
             "music/index.html",
@@ -252,6 +298,1269 @@ class TestSiteGeneration(BaseTest):
         s2 = {"filename": "blah", "base_url": "b", "extra": "hello"}
         self.create_config(tmpdir, theme_dir="t", sitemap_file=s2)
 
+        for bad in ({"format": "html"}, {"max_urls": 0},
+                    {"max_urls": 50001}, {"gzip": "yes"}):
+            bad.update(s1)
+            with pytest.raises(ValueError):
+                self.create_config(tmpdir, theme_dir="t", sitemap_file=bad)
+
+    def read_urlset(self, f, gzipped=False):
+        data = f.read_binary()
+        if gzipped:
+            data = gzip.decompress(data)
+        root = ElementTree.fromstring(data)
+        ns = {"s": SITEMAP_NAMESPACE}
+        assert root.tag == "{%s}urlset" % SITEMAP_NAMESPACE
+        return [(url.find("s:loc", ns).text,
+                 getattr(url.find("s:lastmod", ns), "text", None))
+                for url in root.findall("s:url", ns)]
+
+    def test_xml_sitemap(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        self.create_pages(content, 2)
+        content.join("a b.md").write("")
+        s_gen.config["sitemap_file"] = {"base_url": "http://x",
+                                        "filename": "sitemap.xml"}
+        s_gen.gen_site(str(output))
+        urls = self.read_urlset(output.join("sitemap.xml"))
+        assert sorted(urls, key=lambda u: u[0]) == [
+            ("http://x/", None),
+            ("http://x/a%20b/", urls[1][1]),
+            ("http://x/p0/", "2001-09-09T01:46:40Z"),
+            ("http://x/p1/", "2001-09-09T01:46:41Z"),
+        ]
+
+    def test_gzipped_split_sitemap(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        self.create_pages(content, 6)
+        s_gen.config["sitemap_file"] = {"base_url": "http://x",
+                                        "filename": "sitemap.xml.gz",
+                                        "max_urls": 3}
+        s_gen.gen_site(str(output))
+
+        index = ElementTree.fromstring(
+            gzip.decompress(output.join("sitemap.xml.gz").read_binary())
+        )
+        ns = {"s": SITEMAP_NAMESPACE}
+        assert index.tag == "{%s}sitemapindex" % SITEMAP_NAMESPACE
+        locs = [e.text for e in index.findall("s:sitemap/s:loc", ns)]
+        assert locs == ["http://x/sitemap-{}.xml.gz".format(i)
+                        for i in (1, 2, 3)]
+
+        urls = []
+        for i in (1, 2, 3):
+            part = self.read_urlset(
+                output.join("sitemap-{}.xml.gz".format(i)), gzipped=True
+            )
+            assert 1 <= len(part) <= 3
+            urls.extend(loc for loc, _ in part)
+        # 6 pages plus the home page
+        assert len(urls) == len(set(urls)) == 7
+
+        # the output is deterministic, so is not rewritten
+        s_gen.gen_site(str(output), force=True)
+        assert not [f for f in s_gen.output_changes()["changed"]
+                    if "sitemap" in f]
+
+    def test_text_sitemap_gzip(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        self.create_pages(content, 1)
+        s_gen.config["sitemap_file"] = {"base_url": "b",
+                                        "filename": "sitemap.txt.gz"}
+        s_gen.gen_site(str(output))
+        data = gzip.decompress(output.join("sitemap.txt.gz").read_binary())
+        assert data == b"b/\nb/p0/\n"
+
+class TestIncrementalBuilds(BaseTest):
+    def gen_and_mark(self, s_gen, output, **kwargs):
+        """
+        Generate the site and then overwrite each output file with a marker,
+        so that tests can see which pages are re-rendered in the next build
+        """
+        s_gen.gen_site(str(output), **kwargs)
+        for f in output.visit("*.html"):
+            f.write("old")
+
+    def test_unchanged_pages_skipped(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        content.join("one.md").write("---\none")
+        content.join("two.md").write("---\ntwo")
+
+        self.gen_and_mark(s_gen, output)
+        assert output.join(BuildManifest.filename).check()
+        s_gen.gen_site(str(output))
+        assert output.join("one", "index.html").read() == "old"
+        assert output.join("two", "index.html").read() == "old"
+
+        # changing a source file should only re-render that page
+        content.join("one.md").write("---\nnew contents for one")
+        s_gen.gen_site(str(output))
+        assert "new contents for one" in output.join("one", "index.html").read()
+        assert output.join("two", "index.html").read() == "old"
+
+        # deleted outputs should be recreated
+        output.join("two", "index.html").remove()
+        s_gen.gen_site(str(output))
+        assert output.join("two", "index.html").read() == "<p>two</p>"
+
+        # forced builds should re-render everything
+        self.gen_and_mark(s_gen, output)
+        s_gen.gen_site(str(output), force=True)
+        assert output.join("one", "index.html").read() != "old"
+        assert output.join("two", "index.html").read() != "old"
+
+    def test_rebuild_on_dependency_change(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        templates.join("base.html").write("base {% block b %}{% endblock %}")
+        templates.join("def.html").write(
+            "{% extends 'base.html' %}{% block b %}{{ title }}{% endblock %}"
+        )
+        content.join("one.md").write("")
+
+        # template included by another template has changed
+        self.gen_and_mark(s_gen, output)
+        templates.join("base.html").write("new {% block b %}{% endblock %}")
+        s_gen.gen_site(str(output))
+        assert output.join("one", "index.html").read() == "new One"
+
+        # config has changed
+        self.gen_and_mark(s_gen, output)
+        s_gen.config["default_context"] = {"x": 1}
+        s_gen.gen_site(str(output))
+        assert output.join("one", "index.html").read() == "new One"
+
+        # navigation has changed: a new page was added. Only pages whose
+        # templates use the navigation are re-rendered
+        templates.join("nav.html").write(
+            "{% for p in sitemap %}{{ p.title }}{% endfor %}"
+        )
+        content.join("nav.md").write("template: nav.html\n---\n")
+        self.gen_and_mark(s_gen, output)
+        content.join("two.md").write("")
+        s_gen.gen_site(str(output))
+        assert output.join("nav", "index.html").read() == "NavOneTwo"
+        assert output.join("one", "index.html").read() == "old"
+
+    def test_rebuild_on_navigation_change(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        templates.join("crumbs.html").write(
+            "{{ breadcrumbs|map(attribute='title')|join('/') }}"
+        )
+        templates.join("children.html").write(
+            "{{ children|map(attribute='title')|join('/') }}"
+        )
+        templates.join("siblings.html").write(
+            "{{ siblings|map(attribute='title')|join('/') }}"
+        )
+        blog = content.mkdir("blog")
+        blog.join("index.md").write("template: children.html\n---\n")
+        blog.join("a.md").write("template: crumbs.html\n---\n")
+        blog.join("b.md").write("template: siblings.html\n---\n")
+        other = content.mkdir("other")
+        other.join("c.md").write("template: siblings.html\n---\n")
+
+        # adding a page under /blog/ changes the children of /blog/ and the
+        # siblings of its pages, but not their breadcrumbs
+        self.gen_and_mark(s_gen, output)
+        blog.join("new.md").write("")
+        s_gen.gen_site(str(output))
+        assert output.join("blog", "index.html").read() == "A/B/New"
+        assert output.join("blog", "b", "index.html").read() == "A/B/New"
+        assert output.join("blog", "a", "index.html").read() == "old"
+        assert output.join("other", "c", "index.html").read() == "old"
+        assert stats.report()["manifest_misses"] == 3
+
+        # renaming a parent changes the breadcrumbs of its children
+        self.gen_and_mark(s_gen, output)
+        blog.join("index.md").write(
+            "template: children.html\ntitle: Posts\n---\n"
+        )
+        s_gen.gen_site(str(output))
+        assert output.join("blog", "a", "index.html").read() == "Home/Posts/A"
+        assert output.join("other", "c", "index.html").read() == "old"
+
+    def test_manifest_in_cache_dir(self, tmpdir, site_setup):
+        templates, content, output, s_gen = site_setup
+        content.join("one.md").write("")
+        cache = tmpdir.join("cache")
+        s_gen.config["cache_dir"] = str(cache)
+
+        self.gen_and_mark(s_gen, output)
+        assert not output.join(BuildManifest.filename).check()
+        assert cache.join(os.path.basename(
+            BuildManifest.location(str(output), str(cache))
+        )).check()
+        s_gen.gen_site(str(output))
+        assert output.join("one", "index.html").read() == "old"
+
+
+class TestOutputChanges(BaseTest):
+    def test_identical_output_not_rewritten(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        content.join("page.md").write("---\nhello")
+        s_gen.gen_site(str(output))
+        page_file = output.join("page", "index.html")
+        os.utime(str(page_file), ns=(0, 0))
+
+        s_gen.gen_site(str(output), force=True)
+        assert page_file.mtime() == 0
+        assert stats.report()["outputs_unchanged"] == 2
+        assert not output.join("page", "index.html.tmp").check()
+
+        templates.join("def.html").write("new {{ content }}")
+        s_gen.gen_site(str(output))
+        assert page_file.mtime() != 0
+        assert page_file.read() == "new <p>hello</p>"
+
+    def test_output_changes(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        content.join("one.md").write("---\none")
+        content.join("two.md").write("---\ntwo")
+        content.join("style.css").write("css")
+        s_gen.config["static_filenames"] = ["css"]
+        s_gen.config["sitemap_file"] = {"base_url": "http://x",
+                                        "filename": "sitemap.txt"}
+        s_gen.gen_site(str(output))
+        assert s_gen.output_changes() == {
+            "added": ["index.html", "one/index.html", "sitemap.txt",
+                      "style.css", "two/index.html"],
+            "changed": [],
+            "removed": []
+        }
+
+        s_gen.gen_site(str(output), force=True)
+        assert s_gen.output_changes() == {"added": [], "changed": [],
+                                          "removed": []}
+
+        content.join("one.md").write("---\nnew one")
+        content.join("two.md").remove()
+        content.join("style.css").remove()
+        s_gen.gen_site(str(output))
+        # the home page is re-rendered since the navigation has changed, but
+        # its output is identical
+        assert s_gen.output_changes() == {
+            "added": [],
+            "changed": ["one/index.html", "sitemap.txt"],
+            "removed": ["style.css", "two/index.html"]
+        }
+
+
+class TestHighlightCache(BaseTest):
+    code = "```python\nx = 1\n```\n\n```python\nx = 1\n```\n\n    :::c\n    int x;"
+
+    def test_cached_output_identical(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        highlight.cache.memory.clear()
+        first = Page.content_to_html(self.code)
+        counts = stats.take()
+        # the duplicated block is only highlighted once
+        assert counts["highlight_cache_misses"] == 2
+        assert counts["highlight_cache_hits"] == 1
+        assert Page.content_to_html(self.code) == first
+        assert stats.take()["highlight_cache_hits"] == 3
+        assert 'class="codehilite"' in first
+
+    def test_persistent_cache(self, tmpdir, site_setup):
+        templates, content, output, s_gen = site_setup
+        content.join("page.md").write("---\n" + self.code)
+        s_gen.config["cache_dir"] = str(tmpdir.join("cache"))
+        s_gen = SiteGenerator(s_gen.config)
+        s_gen.gen_site(str(output))
+        html = output.join("page", "index.html").read()
+        entries = tmpdir.join("cache", HighlightCache.dirname).visit("*.html")
+        assert len(list(entries)) == 2
+
+        # a new process would start with an empty memory cache
+        highlight.cache.memory.clear()
+        s_gen.gen_site(str(output), force=True)
+        counts = stats.report()
+        assert counts["highlight_cache_hits"] == 3
+        assert "highlight_cache_misses" not in counts
+        assert output.join("page", "index.html").read() == html
+
+    def test_key(self):
+        from markdown.extensions.codehilite import CodeHilite
+        cache = HighlightCache()
+        key = cache.key(CodeHilite("x = 1", lang="python"), True)
+        assert key == cache.key(CodeHilite("x = 1", lang="python"), True)
+        assert key != cache.key(CodeHilite("x = 2", lang="python"), True)
+        assert key != cache.key(CodeHilite("x = 1", lang="ruby"), True)
+        assert key != cache.key(CodeHilite("x = 1", lang="python",
+                                           linenums=True), True)
+
+    def test_other_converters_unaffected(self):
+        from markdown.extensions.codehilite import CodeHilite
+        Page.content_to_html(self.code)
+        assert CodeHilite.hilite is not highlight.CachedCodeHilite.hilite
+        stats.reset()
+        md = markdown.Markdown(extensions=["markdown.extensions.fenced_code",
+                                           "markdown.extensions.codehilite"])
+        assert md.convert(self.code) == Page.content_to_html(self.code)
+        # only the conversion by mdss's own converter used the cache
+        assert stats.report()["highlight_cache_hits"] == 3
+
+    def test_lexer_memoized(self):
+        lexer = highlight._cached_get_lexer_by_name("python")
+        assert highlight._cached_get_lexer_by_name("python") is lexer
+        assert highlight._cached_get_lexer_by_name("python",
+                                                   stripall=True) is not lexer
+
+
+class TestFrontMatterCache(BaseTest):
+    def test_unchanged_files_not_parsed(self, tmpdir, site_setup, monkeypatch):
+        templates, content, output, s_gen = site_setup
+        templates.join("def.html").write("{{ title }}: {{ content }}")
+        content.join("index.md").write("title: Home page\n---\nhome")
+        content.join("a.md").write("title: Page A\n---\nbody of a")
+        content.join("b.md").write("title: Page B\n---\nbody of b")
+        s_gen.config["cache_dir"] = str(tmpdir.join("cache"))
+
+        parsed = []
+        orig = Page.parse_context
+
+        def counting_parse(page, context_str):
+            parsed.append(page.src_path)
+            return orig(page, context_str)
+        monkeypatch.setattr(Page, "parse_context", counting_parse)
+
+        s_gen.gen_site(str(output))
+        assert len(parsed) == 3
+        assert tmpdir.join("cache", FrontMatterCache.filename).check()
+
+        # nothing changed: no files should be parsed
+        del parsed[:]
+        s_gen.gen_site(str(output), force=True)
+        assert parsed == []
+        assert output.join("a", "index.html").read() == "Page A: <p>body of a</p>"
+        assert output.join("index.html").read() == "Home page: <p>home</p>"
+
+        # only the changed file should be parsed
+        content.join("a.md").write("title: New title\n---\nnew body")
+        s_gen.gen_site(str(output))
+        assert parsed == [str(content.join("a.md"))]
+        assert output.join("a", "index.html").read() == "New title: <p>new body</p>"
+
+    def test_cache_entries(self, tmpdir):
+        f = tmpdir.join("page.md")
+        f.write("")
+        identity = file_identity(str(f))
+        cache_path = str(tmpdir.join("cache.pickle"))
+
+        cache = FrontMatterCache(cache_path)
+        assert cache.get(str(f), identity) is None
+        cache.set(str(f), identity, {"title": "hello"}, 13)
+        cache.save()
+
+        cache = FrontMatterCache(cache_path)
+        assert cache.get(str(f), identity) == ({"title": "hello"}, 13)
+        assert cache.get(str(f), identity[:-1] + (100,)) is None
+        # entries not used in a build should be dropped
+        cache.used = {}
+        cache.save()
+        assert FrontMatterCache(cache_path).get(str(f), identity) is None
+
+    def test_changed_after_cache_hit(self, tmpdir, site_setup):
+        templates, content, output, s_gen = site_setup
+        templates.join("def.html").write("{{ title }}: {{ content }}")
+        content.join("a.md").write("title: Page A\n---\nbody of a")
+        s_gen.config["cache_dir"] = str(tmpdir.join("cache"))
+        s_gen.gen_site(str(output))
+
+        # the content is read from where the cached context section ended
+        s_gen.build_tree()
+        page = s_gen.tree.get("/a/")
+        assert stats.report()["frontmatter_cache_hits"] == 1
+        assert page.get_source() == ({"title": "Page A"}, "body of a")
+
+        # if the file changes after the tree is built, the context is read
+        # again along with the content
+        s_gen.build_tree()
+        content.join("a.md").write("title: A new title\n---\nnew body")
+        os.utime(str(content.join("a.md")), ns=(1, 1))
+        page = s_gen.tree.get("/a/")
+        assert page.get_source() == ({"title": "A new title"}, "new body")
+
+    def test_safe_yaml(self, tmpdir):
+        p = tmpdir.join("unsafe.md")
+        p.write("x: !!python/object/apply:os.getcwd []\n---\n")
+        with pytest.raises(InvalidPageError):
+            Page("unsafe", src_path=str(p))
+
+
+class TestParallelBuilds(BaseTest):
+    def test_parallel_output_identical(self, tmpdir, site_setup):
+        templates, content, output, s_gen = site_setup
+        templates.join("def.html").write("\n".join([
+            "<h1>{{ title }}</h1>",
+            "{% for p in sitemap %}{{ p.path }}{% endfor %}",
+            "{% for p in siblings %}{{ p.title }}{% endfor %}",
+            "{{ content }}"
+        ]))
+        content.join("index.md").write(yaml.dump({
+            "page_ordering": ["zz", "b"]
+        }) + "---\nhome")
+        for d in ("a", "b", "zz"):
+            sub = content.mkdir(d)
+            for i in range(5):
+                sub.join("{}.md".format(i)).write(
+                    "title: page {}\n---\n```python\nx = {}\n```".format(i, i)
+                )
+
+        s_gen.gen_site(str(output))
+        serial = self.read_outputs(output, "*.html")
+
+        parallel_output = tmpdir.mkdir("parallel")
+        s_gen.config["jobs"] = 3
+        s_gen.gen_site(str(parallel_output))
+        assert self.read_outputs(parallel_output, "*.html") == serial
+
+    def test_parallel_in_memory(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        for i in range(4):
+            content.join("{}.md".format(i)).write("---\npage {}".format(i))
+        s_gen.config["jobs"] = 2
+        mem_gen = MemorySiteGenerator(s_gen.config)
+        mem_gen.gen_site()
+        assert mem_gen.files["3/index.html"] == b"<p>page 3</p>"
+        assert not output.listdir()
+
+    def test_worker_reads_bounded(self, monkeypatch, site_setup):
+        templates, content, output, s_gen = site_setup
+        self.create_pages(content, 30)
+        s_gen.config["jobs"] = 2
+        s_gen.worker_batch_size = 1
+        s_gen.build_tree()
+        pages = list(s_gen.tree)
+
+        counts = {"read": 0, "max_ahead": 0}
+        original_get_source = Page.get_source
+
+        def get_source(page):
+            counts["read"] += 1
+            return original_get_source(page)
+
+        monkeypatch.setattr(Page, "get_source", get_source)
+        for done, _ in enumerate(s_gen.render_pages(pages), start=1):
+            counts["max_ahead"] = max(counts["max_ahead"],
+                                      counts["read"] - done)
+        assert counts["read"] == 31
+        # at most 2 * jobs batches of pages are sent to the workers at once
+        assert counts["max_ahead"] <= 4
+
+    def test_jobs_config(self, tmpdir):
+        with pytest.raises(ValueError):
+            self.create_config(tmpdir, theme_dir="t", jobs=-1)
+        with pytest.raises(ValueError):
+            self.create_config(tmpdir, theme_dir="t", jobs="many")
+        assert self.create_config(tmpdir, theme_dir="t", jobs=4).jobs == 4
+        assert self.create_config(tmpdir, theme_dir="t", jobs=0).jobs >= 1
+
+
+class TestStreamedOutput(BaseTest):
+    def test_output_written_while_rendering(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        templates.join("def.html").write(
+            "{% for i in range(3) %}{{ 'x' * 10000 }}{{ size() }}{% endfor %}"
+        )
+        content.join("page.md").write("")
+        page_file = output.join("page", "index.html")
+        # pages are written to a temporary file and then moved into place
+        tmp_file = output.join("page", "index.html.tmp")
+        sizes = []
+
+        def size():
+            if tmp_file.check():
+                sizes.append(tmp_file.size())
+            return ""
+
+        s_gen.env.globals["size"] = size
+        s_gen.output_buffer_size = 1024
+        s_gen.gen_site(str(output))
+        assert page_file.read() == "x" * 30000
+        assert not tmp_file.check()
+        # each chunk should reach the file before the next is rendered
+        assert sizes == [10000, 20000, 30000]
+
+    @pytest.mark.parametrize("jobs", [1, 2])
+    def test_streamed_matches_render(self, site_setup, jobs):
+        templates, content, output, s_gen = site_setup
+        templates.join("def.html").write("<h1>{{ title }}</h1>{{ content }}é")
+        content.join("page.md").write("---\n# Heading\n\ntext")
+        s_gen.config["jobs"] = jobs
+        s_gen.gen_site(str(output))
+        s_gen.build_tree()
+        page = s_gen.tree.get("/page/")
+        expected = s_gen.render_page(page)
+        written = output.join("page", "index.html").read_binary()
+        assert written == expected.encode("utf-8")
+        home = output.join("index.html").read_binary()
+        assert stats.report()["bytes_written"] == len(written) + len(home)
+
+
+class TestPipelinedBuilds(BaseTest):
+    def test_pipeline_output_identical(self, tmpdir, site_setup):
+        templates, content, output, s_gen = site_setup
+        templates.join("def.html").write(
+            "{{ title }}{% for p in siblings %}{{ p.path }}{% endfor %}"
+            "{{ content }}"
+        )
+        self.create_pages(content, 20)
+        s_gen.config["io_threads"] = 0
+        s_gen.gen_site(str(output))
+        expected = self.read_outputs(output, "*.html")
+
+        for io_threads in (1, 3):
+            pipelined = tmpdir.mkdir("pipelined{}".format(io_threads))
+            s_gen.config["io_threads"] = io_threads
+            s_gen.gen_site(str(pipelined))
+            assert self.read_outputs(pipelined, "*.html") == expected
+            assert stats.report()["template_renders"] == 21
+
+    def test_prefetch_bounded(self, monkeypatch, tmpdir, site_setup):
+        templates, content, output, s_gen = site_setup
+        self.create_pages(content, 30)
+        s_gen.config["io_threads"] = 2
+        s_gen.gen_site(str(output))
+
+        counts = {"read": 0, "prepared": 0, "max_ahead": 0}
+        original_get_source = Page.get_source
+        original_prepare = SiteGenerator.prepare_page
+
+        def get_source(page):
+            if threading.current_thread().name == "mdss-reader":
+                counts["read"] += 1
+                counts["max_ahead"] = max(counts["max_ahead"],
+                                          counts["read"] - counts["prepared"])
+            return original_get_source(page)
+
+        def prepare_page(s_gen, page):
+            counts["prepared"] += 1
+            return original_prepare(s_gen, page)
+
+        monkeypatch.setattr(Page, "get_source", get_source)
+        monkeypatch.setattr(SiteGenerator, "prepare_page", prepare_page)
+        s_gen.gen_site(str(output), force=True)
+        assert counts["read"] == 31
+        # the queue holds at most 2 * io_threads pages, plus one page being
+        # read and one being prepared
+        assert counts["max_ahead"] <= 6
+        # context read while building the tree, and content by the reader
+        assert stats.report()["files_read"] == 60
+
+    def test_pipeline_errors(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        templates.join("def.html").write("{{ content }}{{ fail() }}")
+        self.create_pages(content, 30)
+
+        def fail():
+            raise RuntimeError("template error")
+
+        s_gen.env.globals["fail"] = fail
+        with pytest.raises(RuntimeError):
+            s_gen.gen_site(str(output))
+        assert not [t for t in threading.enumerate()
+                    if t.name == "mdss-reader"]
+
+    def test_io_threads_config(self, tmpdir):
+        with pytest.raises(ValueError):
+            self.create_config(tmpdir, theme_dir="t", io_threads=-1)
+        assert self.create_config(tmpdir, theme_dir="t").io_threads == 4
+        assert self.create_config(tmpdir, theme_dir="t",
+                                  io_threads=0).io_threads == 0
+
+
+class TestPrecompression(BaseTest):
+    def test_gzip(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        content.join("one.md").write("---\none")
+        content.join("two.md").write("---\ntwo")
+        content.join("style.css").write("body {}")
+        content.join("image.png").write("png")
+        s_gen.config["static_filenames"] = ["css", "png"]
+        s_gen.config["precompress"] = ["gzip"]
+        s_gen.gen_site(str(output))
+
+        for name in ("index.html", "one/index.html", "style.css"):
+            f = output.join(name)
+            compressed = output.join(name + ".gz")
+            assert gzip.decompress(compressed.read_binary()) == \
+                f.read_binary()
+            assert compressed.mtime() == f.mtime()
+        assert not output.join("image.png.gz").check()
+        assert stats.report()["precompressed_files"] == 4
+
+        # up to date compressed files are skipped
+        s_gen.gen_site(str(output), force=True)
+        counts = stats.report()
+        assert counts["precompress_skipped"] == 4
+        assert "precompressed_files" not in counts
+
+        content.join("one.md").write("---\nnew one")
+        content.join("two.md").remove()
+        s_gen.gen_site(str(output))
+        assert stats.report()["precompressed_files"] == 1
+        assert gzip.decompress(
+            output.join("one", "index.html.gz").read_binary()
+        ) == b"<p>new one</p>"
+        changes = s_gen.output_changes()
+        assert changes["changed"] == ["one/index.html", "one/index.html.gz"]
+        assert changes["removed"] == ["two/index.html", "two/index.html.gz"]
+
+    @pytest.mark.skipif(brotli is None, reason="brotli is not installed")
+    def test_brotli(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        content.join("page.md").write("---\nhello")
+        s_gen.config["precompress"] = ["gzip", "brotli"]
+        s_gen.gen_site(str(output))
+        assert brotli.decompress(
+            output.join("page", "index.html.br").read_binary()
+        ) == b"<p>hello</p>"
+        assert output.join("page", "index.html.gz").check()
+
+    def test_precompress_config(self, tmpdir):
+        with pytest.raises(ValueError):
+            self.create_config(tmpdir, theme_dir="t", precompress="gzip")
+        with pytest.raises(ValueError):
+            self.create_config(tmpdir, theme_dir="t", precompress=["zip"])
+        if brotli is None:
+            with pytest.raises(ValueError):
+                self.create_config(tmpdir, theme_dir="t",
+                                   precompress=["brotli"])
+        assert self.create_config(tmpdir, theme_dir="t",
+                                  precompress=["gzip"]).precompress == ["gzip"]
+
+
+class TestMinify(BaseTest):
+    html = "\n".join([
+        "<html>",
+        "    <!-- a comment -->",
+        "    <!--[if IE]>conditional<![endif]-->",
+        "    <body>",
+        "        <p>Some    text",
+        "           on two lines</p>",
+        "        <pre><code>def f():",
+        "    return  1",
+        "</code></pre>",
+        "        <p>inline <code>a  b</code>   <CODE>c  d</CODE></p>",
+        "        <textarea>  x  </textarea>",
+        "        <script>var  x;</script>",
+        "        <a title=\"x  > y\" href='a  b'>link</a>",
+        "    </body>",
+        "</html>",
+        "",
+    ])
+
+    def test_minify(self):
+        stats.reset()
+        assert minify(self.html) == "\n".join([
+            "<html>",
+            "<!--[if IE]>conditional<![endif]-->",
+            "<body>",
+            "<p>Some text",
+            "on two lines</p>",
+            "<pre><code>def f():",
+            "    return  1",
+            "</code></pre>",
+            "<p>inline <code>a  b</code> <CODE>c  d</CODE></p>",
+            "<textarea>  x  </textarea>",
+            "<script>var  x;</script>",
+            "<a title=\"x  > y\" href='a  b'>link</a>",
+            "</body>",
+            "</html>",
+            "",
+        ])
+        assert stats.report()["minify_bytes_saved"] == 99
+
+    def test_bytes_saved(self):
+        html = "<p>\u00e9</p>  <!-- \u00e9 -->  <p> x </p>"
+        stats.reset()
+        minified = minify(html)
+        assert minified == "<p>\u00e9</p> <p> x </p>"
+        assert stats.report()["minify_bytes_saved"] == \
+            len(html.encode("utf-8")) - len(minified.encode("utf-8"))
+
+    def test_non_ascii_whitespace(self):
+        html = "<p>x\n\u00a0\u00a0indented</p>"
+        stats.reset()
+        assert minify(html) == html
+        assert stats.report().get("minify_bytes_saved", 0) == 0
+
+        stats.reset()
+        assert minify("<p>x \n \u00a0y</p>") == "<p>x\n\u00a0y</p>"
+        assert stats.report()["minify_bytes_saved"] == 2
+
+    def test_attribute_whitespace(self):
+        html = '<p title="x   y"\n   class="a">a   b</p>'
+        assert minify(html) == '<p title="x   y"\n   class="a">a b</p>'
+
+    def test_minify_chunks(self):
+        html = self.html * 20
+        expected = minify(html)
+        rng = random.Random(0)
+        for buffer_size in (1, 10, 100, 1000):
+            chunks = []
+            pos = 0
+            while pos < len(html):
+                size = rng.randint(1, 30)
+                chunks.append(html[pos:pos + size])
+                pos += size
+            minified = list(minify_chunks(chunks, buffer_size=buffer_size))
+            assert "".join(minified) == expected
+            if buffer_size < 1000:
+                assert len(minified) > 1
+
+    def test_minified_build(self, tmpdir, site_setup):
+        templates, content, output, s_gen = site_setup
+        templates.join("def.html").write(
+            "<html>\n  <body>\n    <!-- nav -->\n    {{ content }}\n"
+            "  </body>\n</html>\n"
+        )
+        content.join("page.md").write(
+            "---\nSome text\n\n```python\ndef f():\n    return 1\n```\n"
+        )
+        s_gen.gen_site(str(output))
+        plain = output.join("page", "index.html").read()
+
+        s_gen.config["minify_html"] = True
+        minified_output = tmpdir.mkdir("minified")
+        s_gen.gen_site(str(minified_output))
+        minified = minified_output.join("page", "index.html").read()
+        saved = stats.report()["minify_bytes_saved"]
+        assert minified == minify(plain)
+        assert "<!--" not in minified
+        code = plain[plain.index("<pre>"):plain.index("</pre>")]
+        assert code in minified
+        assert saved == sum(
+            output.join(p, "index.html").size() -
+            minified_output.join(p, "index.html").size()
+            for p in ("", "page")
+        )
+
+    def test_minify_config(self, tmpdir):
+        with pytest.raises(ValueError):
+            self.create_config(tmpdir, theme_dir="t", minify_html="yes")
+        assert not self.create_config(tmpdir, theme_dir="t").minify_html
+
+
+class TestSearchIndex(BaseTest):
+    def create_site(self, content, s_gen):
+        content.join("index.md").write("---\nWelcome home")
+        content.join("fruit.md").write("\n".join([
+            "title: Fruit salad",
+            "---",
+            "# Apples &amp; pears",
+            "Bananas, bananas and *more* bananas.",
+            "",
+            "```python",
+            "secret_variable = 1",
+            "```",
+        ]))
+        sub = content.mkdir("veg")
+        sub.join("carrots.md").write("---\n## Orange\nCarrots like bananas")
+        s_gen.config["search_index"] = {"directory": "search",
+                                        "prefix_length": 2}
+
+    def test_search_extension_optional(self):
+        # text is only kept when building a search index
+        assert not hasattr(Page.get_markdown(), "search_tree")
+        md = Page.get_markdown(search=True)
+        assert md is not Page.get_markdown()
+        Page.content_to_html("Some *text*", search=True)
+        headings, text = page_text(md)
+        assert tokenize(text) == ["some", "text"]
+
+    def read_index(self, output):
+        """
+        Return (index file, map term -> list of (path, score)) for a search
+        index
+        """
+        index = json.loads(output.join("search", "index.json").read())
+        terms = {}
+        for prefix, filename in index["shards"].items():
+            shard = json.loads(output.join("search", filename).read())
+            for term, postings in shard.items():
+                assert term.startswith(prefix)
+                terms[term] = [
+                    (index["documents"][postings[i]][0], postings[i + 1])
+                    for i in range(0, len(postings), 2)
+                ]
+        return index, terms
+
+    def test_tokenize(self):
+        assert tokenize("Hello, World! a x2 _ Caf\u00e9") == \
+            ["hello", "world", "x2", "caf\u00e9"]
+
+    def test_build_index(self):
+        documents = [page_document("a", "One", [], "two two"),
+                     page_document("b", "Two", ["one"], "")]
+        assert build_index(documents, 1) == {
+            "o": {"one": [0, 10, 1, 5]},
+            "t": {"two": [1, 10, 0, 2]},
+        }
+        assert shard_filename("ab") == "terms-ab.json"
+        assert shard_filename("\u00e9") == "terms-xc3a9.json"
+
+    def test_search_index(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        self.create_site(content, s_gen)
+        s_gen.gen_site(str(output))
+
+        index, terms = self.read_index(output)
+        assert index["version"] == 1
+        assert index["prefix_length"] == 2
+        assert sorted(index["documents"]) == [
+            ["", "Home"], ["fruit/", "Fruit salad"], ["veg/", "Veg"],
+            ["veg/carrots/", "Carrots"]
+        ]
+        assert sorted(index["shards"]) == sorted({t[:2] for t in terms})
+        # title, headings, path and body text are all indexed, with weights
+        assert terms["fruit"] == [("fruit/", 10 + 3)]
+        assert terms["apples"] == [("fruit/", 5 + 1)]
+        assert terms["pears"] == [("fruit/", 5 + 1)]
+        assert terms["bananas"] == [("fruit/", 3), ("veg/carrots/", 1)]
+        assert terms["carrots"] == [("veg/carrots/", 10 + 3 + 1)]
+        assert terms["welcome"] == [("", 1)]
+        # code blocks and entities are not indexed
+        assert "secret_variable" not in terms
+        assert "amp" not in terms
+        stats_report = stats.report()
+        assert stats_report["search_documents"] == 4
+        assert stats_report["search_terms"] == len(terms)
+
+    def test_skipped_pages_indexed(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        self.create_site(content, s_gen)
+        s_gen.gen_site(str(output))
+        _, terms = self.read_index(output)
+
+        content.join("veg", "carrots.md").write("---\nCarrots like kiwis")
+        s_gen.gen_site(str(output))
+        assert stats.report()["manifest_hits"] == 3
+        _, new_terms = self.read_index(output)
+        assert new_terms["bananas"] == [("fruit/", 3)]
+        assert new_terms["kiwis"] == [("veg/carrots/", 1)]
+        assert new_terms["fruit"] == terms["fruit"]
+
+    def test_parallel_and_pipelined(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        self.create_site(content, s_gen)
+        s_gen.config["io_threads"] = 0
+        s_gen.gen_site(str(output))
+        expected = self.read_index(output)
+        for jobs, io_threads in ((1, 2), (2, 0)):
+            s_gen.config["jobs"] = jobs
+            s_gen.config["io_threads"] = io_threads
+            s_gen.gen_site(str(output), force=True)
+            assert self.read_index(output) == expected
+
+    def test_merged_shards(self, tmpdir, site_setup):
+        templates, content, output, s_gen = site_setup
+        self.create_site(content, s_gen)
+        s_gen.gen_site(str(output))
+
+        shard_dirs = []
+        for i in (1, 2):
+            shard_dir = tmpdir.mkdir("shard{}".format(i))
+            shard_gen = SiteGenerator(s_gen.config)
+            shard_gen.shard = (i, 2)
+            shard_gen.gen_site(str(shard_dir))
+            assert not shard_dir.join("search").check()
+            shard_dirs.append(str(shard_dir))
+
+        merged = tmpdir.join("merged")
+        SiteGenerator(s_gen.config).merge_shards(str(merged), shard_dirs)
+        assert self.read_index(merged) == self.read_index(output)
+        assert not merged.join(DOCUMENTS_FILENAME).check()
+
+    def test_merged_shards_from_other_machines(self, tmpdir, site_setup):
+        templates, content, output, s_gen = site_setup
+        self.create_site(content, s_gen)
+        s_gen.gen_site(str(output))
+
+        # each shard is built with its own cache dir and then copied to the
+        # machine that merges them
+        shard_dirs = []
+        for i in (1, 2):
+            s_gen.config["cache_dir"] = str(tmpdir.join("cache{}".format(i)))
+            shard_gen = SiteGenerator(s_gen.config)
+            shard_gen.shard = (i, 2)
+            build_dir = tmpdir.join("build{}".format(i))
+            shard_gen.gen_site(str(build_dir))
+            shard_dir = tmpdir.join("shard{}".format(i))
+            build_dir.copy(shard_dir)
+            shard_dirs.append(str(shard_dir))
+
+        s_gen.config["cache_dir"] = str(tmpdir.join("merge-cache"))
+        merged = tmpdir.join("merged")
+        SiteGenerator(s_gen.config).merge_shards(str(merged), shard_dirs)
+        assert self.read_index(merged) == self.read_index(output)
+
+        # a shard without search documents cannot be merged into an index
+        tmpdir.join("shard1", DOCUMENTS_FILENAME).remove()
+        with pytest.raises(MergeError):
+            SiteGenerator(s_gen.config).merge_shards(
+                str(tmpdir.join("merged2")), shard_dirs
+            )
+
+    def test_in_memory(self, tmpdir, site_setup):
+        templates, content, output, s_gen = site_setup
+        self.create_site(content, s_gen)
+        mem_gen = MemorySiteGenerator(s_gen.config)
+        mem_gen.gen_site()
+        index = json.loads(mem_gen.files["search/index.json"])
+        assert len(index["documents"]) == 4
+        assert all("search/" + f in mem_gen.files
+                   for f in index["shards"].values())
+
+    def test_config(self, tmpdir):
+        config = self.create_config(tmpdir, theme_dir="t")
+        assert config.search_index is None
+        config = self.create_config(tmpdir, theme_dir="t", search_index=True)
+        assert config.search_index == {"directory": "search",
+                                       "prefix_length": 2}
+        config = self.create_config(tmpdir, theme_dir="t", search_index={
+            "directory": "find", "prefix_length": 3
+        })
+        assert config.search_index == {"directory": "find",
+                                       "prefix_length": 3}
+        for settings in ("yes", {"directory": "/abs"}, {"prefix_length": 0},
+                         {"prefix_length": 5}, {"prefix_length": "2"}):
+            with pytest.raises(ValueError):
+                self.create_config(tmpdir, theme_dir="t",
+                                   search_index=settings)
+
+
+class TestShardedBuilds(BaseTest):
+    def create_site(self, content, templates, s_gen):
+        templates.join("def.html").write(
+            "{% for p in siblings %}{{ p.path }}{% endfor %}{{ content }}"
+        )
+        for d in ("a", "b"):
+            sub = content.mkdir(d)
+            for i in range(10):
+                sub.join("{}.md".format(i)).write("---\npage {}".format(i))
+            sub.join("{}.css".format(d)).write(d)
+        s_gen.config["static_filenames"] = ["css"]
+        s_gen.config["sitemap_file"] = {"base_url": "http://x",
+                                        "filename": "sitemap.txt"}
+
+    def test_shards_merged(self, tmpdir, site_setup):
+        templates, content, output, s_gen = site_setup
+        self.create_site(content, templates, s_gen)
+        s_gen.gen_site(str(output))
+        expected = self.read_outputs(output)
+
+        shard_dirs = []
+        shard_outputs = []
+        for i in (1, 2, 3):
+            shard_dir = tmpdir.mkdir("shard{}".format(i))
+            shard_gen = SiteGenerator(s_gen.config)
+            shard_gen.shard = (i, 3)
+            shard_gen.gen_site(str(shard_dir))
+            shard_dirs.append(str(shard_dir))
+            shard_outputs.append(set(self.read_outputs(shard_dir)))
+
+        # each output is produced by exactly one shard
+        assert "sitemap.txt" not in set.union(*shard_outputs)
+        assert all(outputs for outputs in shard_outputs)
+        assert sum(len(outputs) for outputs in shard_outputs) == \
+            len(expected) - 1
+        assert set.union(*shard_outputs) == set(expected) - {"sitemap.txt"}
+
+        merged = tmpdir.join("merged")
+        SiteGenerator(s_gen.config).merge_shards(str(merged), shard_dirs)
+        assert self.read_outputs(merged) == expected
+
+        # merging into one of the shard directories
+        SiteGenerator(s_gen.config).merge_shards(shard_dirs[0], shard_dirs)
+        assert self.read_outputs(tmpdir.join("shard1")) == expected
+
+    def test_missing_shard(self, tmpdir, site_setup):
+        templates, content, output, s_gen = site_setup
+        self.create_site(content, templates, s_gen)
+        s_gen.shard = (1, 2)
+        s_gen.gen_site(str(output))
+        with pytest.raises(MergeError):
+            SiteGenerator(s_gen.config).merge_shards(str(tmpdir.join("m")),
+                                                     [str(output)])
+
+
+class TestDevServer(BaseTest):
+    def create_server(self, tmpdir):
+        templates = tmpdir.mkdir("templates")
+        templates.join("def.html").write("{{ title }}: {{ content }}")
+        templates.join("style.css").write("theme css")
+        content = tmpdir.mkdir("content")
+        content.join("page.md").write("---\nhello")
+        config = tmpdir.join("config.yml")
+        config.write(yaml.dump({
+            "theme_dir": str(templates),
+            "default_template": "def.html",
+            "content": str(content)
+        }))
+        server = DevServer(str(config))
+        assert server.build(reload_config=True)
+        return server, templates, content
+
+    def test_build_in_memory(self, tmpdir):
+        server, templates, content = self.create_server(tmpdir)
+        assert server.version == 1
+        body, content_type = server.get_response("/page/")
+        assert content_type == "text/html"
+        assert body.startswith(b"Page: <p>hello</p>")
+        assert DevServer.reload_path.encode("utf-8") in body
+        assert server.get_response("/missing/") is None
+
+        # static files are served from the theme and content directories
+        assert server.get_response("/style.css") == (b"theme css", "text/css")
+        content.join("style.css").write("content css")
+        assert server.get_response("/style.css")[0] == b"content css"
+        assert server.get_response("/../content/page.md") is None
+
+        # nothing should be written to disk
+        assert not tmpdir.join(BuildManifest.filename).check()
+
+    def test_rebuild_on_change(self, tmpdir):
+        server, templates, content = self.create_server(tmpdir)
+        assert not server.check_for_changes()
+
+        content.join("page.md").write("---\nchanged")
+        content.join("new.md").write("---\nnew page")
+        assert server.check_for_changes()
+        assert server.version == 2
+        assert server.wait_for_version(1, timeout=0) == 2
+        assert server.get_response("/page/")[0].startswith(b"Page: <p>changed")
+        assert server.get_response("/new/") is not None
+
+        # removed pages should no longer be served
+        content.join("new.md").remove()
+        assert server.check_for_changes()
+        assert server.get_response("/new/") is None
+
+        # errors should not stop the previous build being served
+        content.join("page.md").write("{invalid\n---\n")
+        assert server.check_for_changes()
+        assert server.version == 3
+        assert server.get_response("/page/") is not None
+
+
+    def test_page_updated_without_full_build(self, tmpdir, monkeypatch):
+        server, templates, content = self.create_server(tmpdir)
+        content.join("other.md").write("title: Other\n---\nother")
+        assert server.check_for_changes()
+        assert server.version == 2
+
+        # changing only the content of a page re-renders just that page
+        def no_full_build(*args, **kwargs):
+            raise AssertionError("full build")
+        monkeypatch.setattr(MemorySiteGenerator, "gen_site", no_full_build)
+        content.join("page.md").write("---\nedited")
+        assert server.check_for_changes()
+        assert server.version == 3
+        assert server.get_response("/page/")[0].startswith(b"Page: <p>edited")
+        assert stats.report()["template_renders"] == 1
+        monkeypatch.undo()
+
+        # changing its context may change the navigation, so the whole site
+        # is rebuilt, but unchanged context sections are not parsed again
+        content.join("page.md").write("title: New title\n---\nedited")
+        assert server.check_for_changes()
+        assert server.version == 4
+        assert server.get_response("/page/")[0].startswith(b"New title: ")
+        assert stats.report()["frontmatter_cache_hits"] == 1
+        assert stats.report()["yaml_parses"] == 1
+
+    def test_no_page_updates_after_failed_build(self, tmpdir):
+        server, templates, content = self.create_server(tmpdir)
+        content.join("bad.md").write("{invalid\n---\n")
+        assert server.check_for_changes()
+        assert not server.built
+
+        # the tree from the failed build may be incomplete, so a change to a
+        # page's content needs a full build, which still fails here
+        content.join("page.md").write("---\nedited")
+        assert server.check_for_changes()
+        assert server.version == 1
+        assert server.get_response("/page/")[0].startswith(b"Page: <p>hello")
+
+class TestTemplateCaching(BaseTest):
+    def test_bytecode_cache(self, tmpdir, site_setup):
+        templates, content, output, s_gen = site_setup
+        content.join("page.md").write("")
+        cache = tmpdir.join("cache")
+        s_gen.config["cache_dir"] = str(cache)
+
+        s_gen = SiteGenerator(s_gen.config)
+        s_gen.gen_site(str(output))
+        assert len(cache.join("jinja").listdir()) == 1
+
+    def test_compiled_theme(self, tmpdir, site_setup):
+        templates, content, output, s_gen = site_setup
+        templates.join("def.html").write("{% include 'inc.html' %}")
+        templates.join("inc.html").write("original")
+        templates.join("style.css").write("{{ not a template")
+        content.join("page.md").write("")
+
+        compiled = tmpdir.join("compiled")
+        assert compile_theme(s_gen.config, str(compiled)) == ["def.html",
+                                                              "inc.html"]
+        # change the source but not the compiled module, so we can tell which
+        # is used
+        def_module = compiled.join(ModuleLoader.get_module_filename("def.html"))
+        def_module.write(def_module.read().replace("inc.html", "other.html"))
+        templates.join("other.html").write("from compiled module")
+
+        s_gen.config["compiled_theme"] = str(compiled)
+        s_gen = SiteGenerator(s_gen.config)
+        s_gen.gen_site(str(output))
+        assert output.join("page", "index.html").read() == "from compiled module"
+
+        # out of date compiled templates should not be used
+        templates.join("def.html").write("{% include 'inc.html' %}!")
+        s_gen.gen_site(str(output))
+        assert output.join("page", "index.html").read() == "original!"
+
+
+class TestProfiling(BaseTest):
+    @pytest.mark.parametrize("jobs", [1, 2])
+    def test_trace(self, tmpdir, site_setup, jobs):
+        templates, content, output, s_gen = site_setup
+        content.join("a.md").write("---\nshort")
+        content.join("b.md").write("---\n" + "long " * 1000)
+        s_gen.config["jobs"] = jobs
+        s_gen.trace = BuildTrace()
+        s_gen.gen_site(str(output))
+
+        events = s_gen.trace.events
+        phases = {e["name"] for e in events if e["cat"] == "phase"}
+        assert {"static", "tree", "render_all", "navigation"} <= phases
+        pages = {e["name"] for e in events if e["cat"] == "page"}
+        assert pages == {"/", "/a/", "/b/"}
+        render_steps = {e["name"] for e in events if e["cat"] == "render"}
+        assert render_steps == {"read", "markdown", "template"}
+        assert len([e for e in events if e["cat"] == "write"]) == 3
+
+        slowest = s_gen.trace.slowest_pages(2)
+        assert len(slowest) == 2
+        assert slowest[0][1] >= slowest[1][1]
+
+        trace_file = tmpdir.join("trace.json")
+        s_gen.trace.write(str(trace_file))
+        written = json.loads(trace_file.read())
+        assert len(written["traceEvents"]) == len(events)
+        assert all(e["ph"] == "X" for e in written["traceEvents"])
+
+    def test_pipelined_trace(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        for name in ("a", "b", "c"):
+            content.join("{}.md".format(name)).write("---\n" + name)
+        s_gen.config["io_threads"] = 2
+        s_gen.trace = BuildTrace()
+        s_gen.gen_site(str(output))
+
+        events = s_gen.trace.events
+        pages = [e for e in events if e["cat"] == "page"]
+        # each page is converted in this thread and its template rendered in
+        # a writer thread, and both count towards the page's time
+        main = threading.get_ident()
+        for e in events:
+            if e["name"] == "template":
+                assert e["tid"] != main
+                assert any(p["tid"] == e["tid"] and p["ts"] <= e["ts"] and
+                           e["ts"] + e["dur"] <= p["ts"] + p["dur"]
+                           for p in pages)
+        slowest = dict(s_gen.trace.slowest_pages())
+        assert set(slowest) == {"/", "/a/", "/b/", "/c/"}
+        for name, duration in slowest.items():
+            spans = [p for p in pages if p["name"] == name]
+            assert len(spans) == 2
+            assert duration == pytest.approx(
+                sum(p["dur"] for p in spans) / 1e6
+            )
+
+    def test_cprofile_includes_rendering(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        for name in ("a", "b", "c"):
+            content.join("{}.md".format(name)).write("---\n" + name)
+        s_gen.profiler = cProfile.Profile()
+        s_gen.gen_site(str(output))
+        functions = {func for _, _, func in pstats.Stats(s_gen.profiler).stats}
+        assert {"write_page", "generate", "write_output"} <= functions
+
+    def test_null_trace(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        content.join("a.md").write("")
+        s_gen.gen_site(str(output))
+        assert not s_gen.trace.enabled
+        assert s_gen.trace.pop_events() == []
+
+
+class TestBuildStats(BaseTest):
+    @pytest.mark.parametrize("jobs", [1, 2])
+    def test_counters(self, site_setup, jobs):
+        templates, content, output, s_gen = site_setup
+        content.join("a.md").write("title: A\n---\nhello <?m>x<?/m>")
+        content.join("b.md").write("---\nworld")
+        content.join("style.css").write("")
+        s_gen.config["static_filenames"] = ["css"]
+        s_gen.config["macros"] = "def m(s): return s"
+        s_gen.config["jobs"] = jobs
+        s_gen.gen_site(str(output))
+
+        counts = stats.report()
+        # each content file's context is read while building the tree, and
+        # its content when rendering; each byte is read and parsed once
+        assert counts["files_read"] == 4
+        assert counts["bytes_read"] == sum(
+            content.join(f).size() for f in ("a.md", "b.md")
+        )
+        assert counts["yaml_parses"] == 2
+        # one conversion per page, plus one for the macro body
+        assert counts["markdown_conversions"] == 4
+        assert counts["macro_expansions"] == 1
+        assert counts["template_renders"] == 3
+        assert counts["manifest_misses"] == 3
+        assert counts["files_written"] == 3
+        assert counts["bytes_written"] == sum(
+            output.join(p, "index.html").size() for p in ("", "a", "b")
+        )
+        assert counts["static_files_copied"] == 1
+        assert counts["peak_rss_bytes"] > 0
+
+        # counters are reset for each build
+        s_gen.gen_site(str(output))
+        counts = stats.report()
+        assert counts["manifest_hits"] == 3
+        assert counts["static_files_skipped"] == 1
+        assert "template_renders" not in counts
+        assert "files_written" not in counts
+
+    def test_frontmatter_cache_counters(self, tmpdir, site_setup):
+        templates, content, output, s_gen = site_setup
+        content.join("a.md").write("---\nhello")
+        s_gen.config["cache_dir"] = str(tmpdir.join("cache"))
+        s_gen.gen_site(str(output))
+        assert stats.report()["frontmatter_cache_misses"] == 1
+
+        # nothing is read when neither the context nor the output is needed
+        s_gen.gen_site(str(output))
+        counts = stats.report()
+        assert counts["frontmatter_cache_hits"] == 1
+        assert "files_read" not in counts
+
+    def test_write_report(self, tmpdir):
+        stats.reset()
+        stats.incr("files_read")
+        stats.incr("bytes_read", 10)
+        stats.merge({"bytes_read": 5})
+        path = tmpdir.join("stats.json")
+        stats.write_report(str(path))
+        written = json.loads(path.read())
+        assert written["files_read"] == 1
+        assert written["bytes_read"] == 15
+        assert "peak_rss_bytes" in written
+
+
 class TestStaticFiles(BaseTest):
     def test_static(self, site_setup):
         templates, content, output, s_gen = site_setup
@@ -299,6 +1608,61 @@ class TestStaticFiles(BaseTest):
         assert double_file.check()
         assert double_file.read() == "content version"
 
+    def test_static_overlay(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        templates.join("a.css").write("theme")
+        content.join("a.css").write("content")
+        content.join("b.css").write("b")
+        assert s_gen.find_static_files() == {
+            "a.css": str(content.join("a.css")),
+            "b.css": str(content.join("b.css")),
+        }
+
+    def test_unchanged_static_skipped(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        content.join("a.css").write("aaa")
+        content.join("b.css").write("bbb")
+        assert s_gen.export_static(str(output)) == ["a.css", "b.css"]
+        assert s_gen.export_static(str(output)) == []
+
+        # same size and mtime: assumed unchanged
+        src_st = os.stat(str(content.join("a.css")))
+        output.join("a.css").write("xxx")
+        os.utime(str(output.join("a.css")),
+                 ns=(src_st.st_atime_ns, src_st.st_mtime_ns))
+        # same contents with a different mtime: unchanged
+        content.join("b.css").write("bbb")
+        os.utime(str(content.join("b.css")), (0, 0))
+        assert s_gen.export_static(str(output)) == []
+        assert output.join("a.css").read() == "xxx"
+
+        # changed contents
+        content.join("a.css").write("new")
+        assert s_gen.export_static(str(output)) == ["a.css"]
+        assert output.join("a.css").read() == "new"
+
+    @pytest.mark.parametrize("mode", COPY_MODES)
+    def test_copy_modes(self, site_setup, mode):
+        templates, content, output, s_gen = site_setup
+        content.mkdir("sub").join("a.css").write("aaa")
+        s_gen.config["static_copy_mode"] = mode
+        s_gen.export_static(str(output))
+
+        src = content.join("sub", "a.css")
+        dest = output.join("sub", "a.css")
+        assert dest.read() == "aaa"
+        assert os.path.samefile(str(src), str(dest)) == (mode == "hardlink")
+
+        # replacing the source should not modify the old file
+        src.remove()
+        src.write("replaced")
+        s_gen.export_static(str(output))
+        assert dest.read() == "replaced"
+
+    def test_copy_mode_config(self, tmpdir):
+        with pytest.raises(ValueError):
+            self.create_config(tmpdir, theme_dir="t", static_copy_mode="move")
+
 
 class TestPageRendering(BaseTest):
 
@@ -418,6 +1782,112 @@ class TestPageRendering(BaseTest):
         expected_html = "<p>This should be <strong>Markdown</strong></p>"
         assert s_gen.render_page(page) == expected_html
 
+    def test_markdown_converter_reused(self):
+        md = Page.get_markdown()
+        assert Page.get_markdown() is md
+        # state should not carry over between documents
+        assert Page.content_to_html("# Title") == Page.content_to_html("# Title")
+        assert 'id="title"' in Page.content_to_html("# Title")
+
+        # each thread should have its own converter
+        others = []
+        t = threading.Thread(target=lambda: others.append(Page.get_markdown()))
+        t.start()
+        t.join()
+        assert others[0] is not md
+
+    def test_template_variables(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        templates.join("base.html").write(
+            "{% for p in sitemap %}{{ p.title }}{% endfor %}"
+            "{% block body %}{% endblock %}"
+        )
+        templates.join("leaf.html").write(
+            "{% extends 'base.html' %}"
+            "{% block body %}{% set x = siblings %}{{ content }}{% endblock %}"
+        )
+        templates.join("dynamic.html").write("{% include name %}")
+        assert s_gen.template_variables("def.html") == {"content"}
+        assert s_gen.template_variables("leaf.html") == {"sitemap", "siblings",
+                                                         "content"}
+        # any template could be included
+        assert {"name", "sitemap"} <= s_gen.template_variables("dynamic.html")
+
+    def test_dynamic_include_with_static_files(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        templates.join("def.html").write("{% include inc %}")
+        templates.join("part.html").write("{{ title }}")
+        templates.join("broken.txt").write("{% if %}")
+        templates.join("logo.png").write_binary(b"\x89PNG\r\n\x1a\n\xff\xfe")
+        content.join("index.md").write("inc: part.html\n---\n")
+        content.join("page.md").write("inc: part.html\n---\n")
+        s_gen.gen_site(str(output))
+        assert output.join("page", "index.html").read() == "Page"
+        assert output.join("logo.png").check()
+        # static files and invalid templates are not dependencies
+        deps = {os.path.basename(p)
+                for p in s_gen.template_dependencies("def.html")}
+        assert deps == {"def.html", "part.html"}
+
+    def test_include_ignore_missing(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        templates.join("def.html").write(
+            "<html>{% include 'missing.html' ignore missing %}"
+            "{{ content }}</html>"
+        )
+        content.join("page.md").write("---\nhello")
+        s_gen.gen_site(str(output))
+        assert output.join("page", "index.html").read() == \
+            "<html><p>hello</p></html>"
+        deps = {os.path.basename(p)
+                for p in s_gen.template_dependencies("def.html")}
+        assert deps == {"def.html", "missing.html"}
+
+        # creating the missing template should re-render the page
+        templates.join("missing.html").write("new")
+        s_gen.gen_site(str(output))
+        assert output.join("page", "index.html").read() == \
+            "<html>new<p>hello</p></html>"
+
+    def test_include_list(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        templates.join("def.html").write(
+            "<html>{% include ['nope.html', 'part.html'] %}"
+            "{{ content }}</html>"
+        )
+        templates.join("part.html").write("part{{ children|length }}")
+        content.join("page.md").write("---\nhello")
+        s_gen.gen_site(str(output))
+        assert output.join("page", "index.html").read() == \
+            "<html>part0<p>hello</p></html>"
+        assert "children" in s_gen.template_variables("def.html")
+
+        templates.join("nope.html").write("nope")
+        s_gen.gen_site(str(output))
+        assert output.join("page", "index.html").read() == \
+            "<html>nope<p>hello</p></html>"
+
+    def test_unused_navigation_not_computed(self, monkeypatch, site_setup):
+        templates, content, output, s_gen = site_setup
+        templates.join("nav.html").write(
+            "{% for c in children %}{{ c.title }}{% endfor %}"
+        )
+        content.join("leaf.md").write("---\nleaf")
+        content.join("parent.md").write("template: nav.html\n---\n")
+        content.mkdir("parent").join("child.md").write("")
+
+        calls = []
+        original = Navigation.children
+        monkeypatch.setattr(Navigation, "children",
+                            lambda nav, page: calls.append(page.dest_path) or
+                            original(nav, page))
+        monkeypatch.setattr(Navigation, "siblings",
+                            lambda nav, page: pytest.fail("siblings used"))
+        s_gen.gen_site(str(output))
+        assert calls == ["/parent/"]
+        assert output.join("parent", "index.html").read() == "Child"
+        assert output.join("leaf", "index.html").read() == "<p>leaf</p>"
+
     def test_title_handling(self, site_setup):
         """
         Check that a title is generated based on filename if title not
@@ -479,6 +1949,44 @@ class TestPageRendering(BaseTest):
         assert context == {"title": "something"}
         assert content == ""
 
+    def test_source_read_once(self, site_setup, monkeypatch):
+        templates, content, output, s_gen = site_setup
+        content.join("index.md").write("title: home\n---\nhome")
+        content.mkdir("sub").join("page.md").write("---\n**bold**")
+
+        reads = []
+        orig = Page.read_page_source
+
+        def counting_read(page, *args, **kwargs):
+            reads.append(page.src_path)
+            return orig(page, *args, **kwargs)
+        monkeypatch.setattr(Page, "read_page_source", counting_read)
+
+        s_gen.gen_site(str(output))
+        assert sorted(reads) == sorted([str(content.join("index.md")),
+                                        str(content.join("sub", "page.md"))])
+        assert "<strong>bold</strong>" in output.join("sub/page/index.html").read()
+        # content should be released once pages are rendered
+        assert all(page.content is None for page in s_gen.tree)
+
+    def test_content_read_when_rendered(self, tmpdir):
+        p = tmpdir.join("mypage.md")
+        p.write("title: old\n---\nold content\n---\nmore\n")
+        page = Page("mypage", str(p))
+        # only the context is held until the page is rendered
+        assert page.content is None
+        assert page.get_source() == ({"title": "old"}, "old content\nmore\n")
+        page.release_content()
+        assert page.get_source()[1] == "old content\nmore\n"
+
+        # if the file changes after its context is read, the context and
+        # content are both read from the new version
+        page.release_content()
+        p.write("title: a new title\n---\nnew content\n")
+        os.utime(str(p), ns=(1, 1))
+        assert page.get_source() == ({"title": "a new title"},
+                                     "new content\n")
+
     def test_child_listing(self, site_setup):
         templates, content, output, s_gen = site_setup
         templates.join("c.html").write("\n".join([
@@ -641,6 +2149,135 @@ class TestPageRendering(BaseTest):
         assert remove_empties(home_output.readlines()) == []
 
 
+class TestNavigation(BaseTest):
+    def test_shared_listings(self):
+        tree = SiteTree()
+        tree.insert(Page("c"), location=["a", "b"])
+        tree.insert(Page("d"), location=["a"])
+        nav = tree.navigation
+        # navigation should only be built once
+        assert tree.navigation is nav
+
+        a_info = nav.sitemap[0]
+        assert a_info.path == "/a/"
+        a_page = tree.root.children["a"]
+        assert nav.children(a_page) is a_info.children
+        assert nav.siblings(a_page) is nav.sitemap
+        assert nav.siblings(tree.root) == ()
+        assert [p.path for p in a_info.children] == ["/a/b/", "/a/d/"]
+        assert [p.path for p in a_info.children[0].children] == ["/a/b/c/"]
+
+        # modifying the tree should cause navigation to be rebuilt
+        tree.insert(Page("e"), location=[])
+        assert tree.navigation is not nav
+        assert [p.path for p in tree.navigation.sitemap] == ["/a/", "/e/"]
+
+
+class TestSiteTree(BaseTest):
+    def create_tree(self):
+        tree = SiteTree()
+        tree.insert(Page("first-post"), location=["blog", "2018", "may"])
+        tree.insert(Page("second-post"), location=["blog", "2018", "june"])
+        tree.insert(Page("my-page"), location=[])
+        return tree
+
+    def test_get(self):
+        tree = self.create_tree()
+        may = tree.get("/blog/2018/may/")
+        assert may.id == "may"
+        assert tree.get("blog/2018/may") is may
+        assert tree.get("/") is tree.root
+        assert tree.get("") is tree.root
+        assert tree.get("/blog/2019/") is None
+
+        # replacing a page should update the index, and existing children
+        # should still be found
+        new_may = Page("may")
+        tree.insert(new_may, location=["blog", "2018"])
+        assert tree.get("/blog/2018/may/") is new_may
+        assert tree.get("/blog/2018/may/first-post/").parent is new_may
+
+        home = HomePage()
+        tree.set_root(home)
+        assert tree.get("/") is home
+
+    def test_select(self):
+        tree = self.create_tree()
+
+        def paths(pattern):
+            return [p.dest_path for p in tree.select(pattern)]
+
+        assert paths("blog/**") == [
+            "/blog/2018/", "/blog/2018/june/", "/blog/2018/june/second-post/",
+            "/blog/2018/may/", "/blog/2018/may/first-post/"
+        ]
+        assert paths("blog/*/*") == ["/blog/2018/june/", "/blog/2018/may/"]
+        assert paths("**/*-post") == ["/blog/2018/june/second-post/",
+                                      "/blog/2018/may/first-post/"]
+        assert paths("/blog/2018/ma?/") == ["/blog/2018/may/"]
+        assert paths("*") == ["/blog/", "/my-page/"]
+        assert paths("nothing/**") == []
+
+    def test_insert_does_not_sort(self, monkeypatch):
+        # inserting pages should not need to list each level's children
+        def fail(page):
+            raise AssertionError("iterchildren() called")
+
+        tree = SiteTree()
+        monkeypatch.setattr(Page, "iterchildren", fail)
+        for i in range(100):
+            tree.insert(Page("post{}".format(i)), location=["blog", "2018"])
+        assert len(tree.get("/blog/2018/").children) == 100
+
+
+class TestBenchmark(BaseTest):
+    def test_generate_site(self, tmpdir):
+        config_path = generate_site(str(tmpdir), pages=30, depth=2, fanout=3,
+                                    body_size=200, static_files=4,
+                                    static_size=10)
+        config = SiteConfig(config_path)
+        pages = list(SiteGenerator.walk_tree(config.content, ["md"]))
+        assert len(pages) == 30
+        assert max(len(SiteGenerator.split_path(p)) for p in pages) == 3
+        static = SiteGenerator(config).find_static_files()
+        assert len(static) == 4
+
+        # the same parameters should produce the same site
+        generate_site(str(tmpdir.join("again")), pages=30, depth=2, fanout=3,
+                      body_size=200, static_files=4, static_size=10)
+        for p in pages:
+            assert (tmpdir.join("content", p).read() ==
+                    tmpdir.join("again", "content", p).read())
+
+    def test_page_location(self):
+        leaves = {tuple(page_location(i, 3, 10)) for i in range(1000)}
+        assert len(leaves) == 1000
+        # each level has `fanout` directories
+        for level in range(3):
+            assert len({leaf[level] for leaf in leaves}) == 10
+        assert page_location(123, 3, 10) == ["d1", "d2", "d3"]
+
+    @pytest.mark.parametrize("body_size", [2000, 20000])
+    def test_body_size(self, body_size):
+        rng = random.Random(0)
+        for _ in range(10):
+            body = generate_body(rng, body_size, 0.2, 0.1)
+            # bodies stop growing once they reach the requested size, after
+            # at most one paragraph, code block and macro
+            assert body_size <= len(body) < body_size + 1000
+
+    def test_run_benchmark(self, tmpdir):
+        results = run_benchmark(str(tmpdir), pages=10, static_files=2,
+                                body_size=100)
+        assert set(results["timings"]) == {
+            "walk", "tree", "render", "write", "static", "full_build",
+            "noop_rebuild"
+        }
+        assert results["params"]["pages"] == 10
+        # results should be serialisable
+        json.dumps(results)
+
+
 class TestConfigs(BaseTest):
     def test_basic(self, tmpdir):
         class MyConfig(BaseConfig):
@@ -796,6 +2433,50 @@ class TestMacros(BaseTest):
             s_gen.gen_site(str(output))
 
 
+    def test_pure_macros(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        s_gen.config["macros"] = "\n".join([
+            "def counted(s, calls=[], **kwargs):",
+            "    calls.append(s)",
+            "    return '{}:{}'.format(len(calls), s)",
+        ])
+        s_gen.config["pure_macros"] = ["counted"]
+        for name in ("a", "b", "c"):
+            content.join("{}.md".format(name)).write("\n".join([
+                "---",
+                "<?counted x=1>same<?/counted>",
+                "<?counted x=2>same<?/counted>",
+            ]))
+        s_gen.gen_site(str(output))
+
+        # the first invocation should be evaluated once for all pages
+        for name in ("a", "b", "c"):
+            html = output.join(name, "index.html").read()
+            assert "1:same" in html
+            assert "2:same" in html
+
+    def test_macros_compiled_once(self, site_setup):
+        templates, content, output, s_gen = site_setup
+        s_gen.config["macros"] = "def m(s):\n    return s"
+        handler = s_gen.get_macro_handler()
+        assert s_gen.get_macro_handler() is handler
+
+        s_gen.config["macros"] = "def m2(s):\n    return s"
+        assert s_gen.get_macro_handler() is not handler
+
+        s_gen.config["pure_macros"] = ["unknown"]
+        with pytest.raises(ValueError):
+            s_gen.get_macro_handler()
+
+    def test_pure_macros_config(self, tmpdir):
+        config = self.create_config(tmpdir, theme_dir="t",
+                                    pure_macros=["callout"])
+        assert config.pure_macros == ["callout"]
+        for names in ("callout", ["callout", 1]):
+            with pytest.raises(ValueError):
+                self.create_config(tmpdir, theme_dir="t", pure_macros=names)
+
+
 class TestCachedPropertyDecorator(BaseTest):
     def test_cached_prop_decorator(self):
         class MyClass:
@@ -876,3 +2557,19 @@ class TestPageOrdering(BaseTest):
             "Zebras", "Dogs", "Snakes", "A story about turtles", "Aardvarks",
             "Cats"
         ]
+
+    def test_children_order_cached(self, tmpdir):
+        index = tmpdir.join("index.md")
+        index.write(yaml.dump({"page_ordering": ["c", "a.md", "c"]}) + "---")
+        home = HomePage(str(index))
+        assert home.child_positions == {"c": 0, "a": 1}
+
+        for p_id in ("b", "a", "c"):
+            home.add_child(Page(p_id))
+        children = home.iterchildren()
+        assert [p.id for p in children] == ["c", "a", "b"]
+        assert home.iterchildren() is children
+
+        # adding a child should invalidate the cached order
+        home.add_child(Page("0"))
+        assert [p.id for p in home.iterchildren()] == ["c", "a", "0", "b"]
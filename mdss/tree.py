@@ -1,5 +1,81 @@
-from mdss.page import Page, HomePage
-from mdss.utils import transfer_pages
+import re
+
+from mdss.page import Page, HomePage, PageInfo
+from mdss.utils import transfer_pages, fingerprint
+
+
+# context variables derived from the site navigation. These are only computed
+# for pages whose templates use them
+NAVIGATION_VARIABLES = {"breadcrumbs", "children", "sitemap", "siblings"}
+
+class Navigation:
+    """
+    Listings of pages for use in templates, computed once for the whole tree.
+
+    Listings are tuples of PageInfo objects and are shared: the `children` of
+    the PageInfo for a page is the same object as the listing for that page,
+    so building the navigation for the whole site is O(N)
+    """
+    def __init__(self, root):
+        # map page dest path -> listing of that page's children
+        self.listings = {}
+        # map page dest path -> hash of the listing of that page's children
+        self.fingerprints = {}
+        self.root_path = root.dest_path
+        self.sitemap = self.build_listing(root)
+
+    def build_listing(self, page):
+        listing = tuple(
+            PageInfo(child.dest_path, child.title, self.build_listing(child))
+            for child in page.iterchildren()
+        )
+        self.listings[page.dest_path] = listing
+        return listing
+
+    def children(self, page):
+        """
+        Return the listing of a page's children
+        """
+        return self.listings.get(page.dest_path, ())
+
+    def siblings(self, page):
+        """
+        Return the listing of the pages at the same level as `page`
+        """
+        if page.parent is None:
+            return ()
+        return self.children(page.parent)
+
+    def listing_fingerprint(self, path):
+        """
+        Return a hash of the listing of the children of the page with dest
+        path `path` (the path and title of each page beneath it, in order)
+        """
+        if path not in self.fingerprints:
+            self.fingerprints[path] = fingerprint([
+                (p.path, p.title, self.listing_fingerprint(p.path))
+                for p in self.listings.get(path, ())
+            ])
+        return self.fingerprints[path]
+
+    def fingerprint(self, page=None, variables=NAVIGATION_VARIABLES):
+        """
+        Return a hash of the navigation data for `page` given by the template
+        variables listed in `variables`, or of the whole sitemap if `page` is
+        None
+        """
+        if page is None:
+            return self.listing_fingerprint(self.root_path)
+        data = {}
+        if "breadcrumbs" in variables:
+            data["breadcrumbs"] = [(p.path, p.title) for p in page.breadcrumbs]
+        if "children" in variables:
+            data["children"] = self.listing_fingerprint(page.dest_path)
+        if "siblings" in variables and page.parent is not None:
+            data["siblings"] = self.listing_fingerprint(page.parent.dest_path)
+        if "sitemap" in variables:
+            data["sitemap"] = self.listing_fingerprint(self.root_path)
+        return fingerprint(data)
 
 
 class SiteTree:
@@ -9,6 +85,19 @@ class SiteTree:
 
     def __init__(self):
         self.root = HomePage()
+        # map dest path -> page for every page in the tree
+        self.pages = {self.root.dest_path: self.root}
+        self._navigation = None
+
+    @property
+    def navigation(self):
+        """
+        Navigation listings for the tree. These are built the first time they
+        are needed after the tree is modified
+        """
+        if self._navigation is None:
+            self._navigation = Navigation(self.root)
+        return self._navigation
 
     def set_root(self, new_root):
         """
@@ -16,6 +105,8 @@ class SiteTree:
         """
         transfer_pages(self.root, new_root)
         self.root = new_root
+        self.pages[new_root.dest_path] = new_root
+        self._navigation = None
 
     def insert(self, new_page, location, insert_at=None):
         """
@@ -27,27 +118,68 @@ class SiteTree:
         insert_at - the node under which to insert (default: root)
         """
         start = insert_at or self.root
+        self._navigation = None
 
-        # if page has no location then it lives under this node
-        if not location:
-            start.add_child(new_page)
-            return
+        # find the page under which the new page should live, creating pages
+        # for any directories that do not have one yet
+        for p_id in location:
+            child = start.children.get(p_id)
+            if child is None:
+                child = Page(p_id)
+                start.add_child(child)
+                self.pages[child.dest_path] = child
+            start = child
 
-        # if page is at a lower level in the hierarchy, find the child under
-        # which it should live
-        next_insert_at = None
-        for child in start.iterchildren():
-            if child.id == location[0]:
-                next_insert_at = child
-                break
+        start.add_child(new_page)
+        self.pages[new_page.dest_path] = new_page
+
+    @staticmethod
+    def normalise_path(path):
+        """
+        Return a path in the form used for page dest paths, with leading and
+        trailing slashes
+        """
+        return "/" + "".join(part + "/" for part in path.split("/") if part)
+
+    def get(self, path, default=None):
+        """
+        Return the page with the given path (e.g. '/blog/2018/may/'), or
+        `default` if there is no such page
+        """
+        return self.pages.get(self.normalise_path(path), default)
 
-        # if none found create a new one
-        if not next_insert_at:
-            dummy_page = Page(location[0])
-            start.add_child(dummy_page)
-            next_insert_at = dummy_page
+    @staticmethod
+    def compile_pattern(pattern):
+        """
+        Return a regex matching page paths for a glob pattern. '*' matches
+        within a single path component and '**' matches any number of
+        components. As in .gitignore files, a trailing '**' matches
+        everything beneath a page but not the page itself
+        """
+        parts = [part for part in pattern.split("/") if part]
+        regex = "/"
+        for i, part in enumerate(parts):
+            if part == "**":
+                regex += "(?:[^/]+/)+" if i == len(parts) - 1 else "(?:[^/]+/)*"
+                continue
+            for char in part:
+                if char == "*":
+                    regex += "[^/]*"
+                elif char == "?":
+                    regex += "[^/]"
+                else:
+                    regex += re.escape(char)
+            regex += "/"
+        return re.compile(regex + r"\Z")
 
-        self.insert(new_page, location[1:], insert_at=next_insert_at)
+    def select(self, pattern):
+        """
+        Return a list of pages whose paths match a glob pattern (see
+        compile_pattern()), in tree order. E.g. 'blog/**' matches all pages
+        beneath /blog/
+        """
+        regex = self.compile_pattern(pattern)
+        return [page for page in self if regex.match(page.dest_path)]
 
     def iter_node(self, start):
         """
@@ -59,3 +191,9 @@ class SiteTree:
 
     def __iter__(self):
         return self.iter_node(self.root)
+
+    def fingerprint(self):
+        """
+        Return a hash of the navigation data for the site
+        """
+        return self.navigation.fingerprint()
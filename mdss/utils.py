@@ -1,3 +1,14 @@
+import os
+import json
+import hashlib
+
+import yaml
+
+# use the libyaml-based loader if available, since it is much faster than the
+# pure Python one
+YAMLLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
 def remove_extension(path, ext):
     """
     Remove an extension from a file path. `ext` should not include '.'
@@ -14,3 +25,67 @@ def transfer_pages(from_page, to_page):
     """
     for child in from_page.iterchildren():
         to_page.add_child(child)
+
+
+def file_signature(path):
+    """
+    Return a cheap signature of a file that changes whenever the file is
+    modified, or None if the file does not exist
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def file_hash(path, block_size=1 << 16):
+    """
+    Return the SHA-1 hex digest of a file's contents
+    """
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def shard_number(path, count):
+    """
+    Return the shard (numbered from 1 to `count`) that the output at `path`
+    belongs to. This only depends on the path, so outputs are assigned to the
+    same shard on every machine and in every build
+    """
+    digest = hashlib.sha1(path.encode("utf-8")).hexdigest()
+    return int(digest[:8], 16) % count + 1
+
+
+def fingerprint(obj):
+    """
+    Return a hex digest identifying a JSON-serialisable object
+    """
+    s = json.dumps(obj, sort_keys=True, default=str)
+    return hashlib.sha1(s.encode("utf-8")).hexdigest()
+
+
+def load_yaml(stream):
+    """
+    Parse a YAML document from a string or file
+    """
+    return yaml.load(stream, Loader=YAMLLoader)
+
+
+def file_identity(path):
+    """
+    Return a signature identifying a file and its current version: its device,
+    inode, modification time and size
+    """
+    return stat_identity(os.stat(path))
+
+
+def stat_identity(st):
+    """
+    Return the file_identity() of a file from the result of os.stat() or
+    os.fstat()
+    """
+    return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
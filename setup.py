@@ -8,6 +8,7 @@ setup(
     version="1.0.0",
     description="Build static websites with jinja2 templates and markdown",
     install_requires=requirements,
+    python_requires=">=3.7",
     packages=find_packages(),
     entry_points={
         "console_scripts": [